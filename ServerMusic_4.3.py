@@ -1,4 +1,9 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import functools
+import glob
 import aiohttp
 from aiohttp import web
 import yt_dlp
@@ -7,12 +12,26 @@ import logging
 import urllib.parse
 import os
 import hashlib
+import io
 import aiofiles
 import re
-import subprocess
+import sys
+import unicodedata
+import sqlite3
+import time
 import psutil
-import gc  # Garbage collect
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from mutagen.mp3 import MP3  # pip install mutagen
+try:
+    import fcntl  # POSIX: khoá file giữa các worker
+except ImportError:
+    fcntl = None
+try:
+    from PIL import Image, ImageOps  # pip install pillow
+except ImportError:
+    Image = None  # Không có Pillow: /cover trả ảnh gốc, không resize
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
@@ -35,18 +54,575 @@ YOUTUBE_HEADERS = {
 CACHE_DIR = 'music_cache'
 os.makedirs(CACHE_DIR, exist_ok=True)
 
-# Semaphore for concurrent
-background_semaphore = asyncio.Semaphore(3)
+# Index metadata cho cache (ngoài CACHE_DIR để không bị serve / cleanup xoá)
+CACHE_INDEX_PATH = 'music_cache_index.db'
+INDEX_TOUCH_FLUSH_INTERVAL = 10  # giây, ghi last_access dồn lại xuống SQLite
+DEFAULT_COVER_URL = "http://y.gtimg.cn/music/photo_new/T002R300x300M000004AfbeH1xUvTe.jpg"
 
-def log_memory(prefix=""):
+class CacheIndex:
+    """SQLite index of cached tracks, keyed by track id.
+
+    A track id is the YouTube video id (or the query hash when the video id
+    is unknown). The aliases table maps canonical query hashes to track ids so
+    every phrasing of a song finds the same file. All rows are mirrored in
+    memory at startup so a warm hit is a dict lookup; writes go through to
+    SQLite so the index survives restarts and is shared by server workers
+    (refresh() re-reads a row another worker may have changed). Read hits only
+    update last_access in memory; flush_touches() writes them in one batch.
+    `files` is the JSON {file name: bytes} of everything cached for the track.
+    """
+    FIELDS = ('title', 'artist', 'duration', 'thumbnail', 'video_id', 'file_size', 'bitrate', 'last_access',
+              'checksum', 'audio_duration', 'files')
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS tracks (
+            hash TEXT PRIMARY KEY,
+            title TEXT,
+            artist TEXT,
+            duration INTEGER,
+            thumbnail TEXT,
+            video_id TEXT,
+            file_size INTEGER DEFAULT 0,
+            bitrate INTEGER DEFAULT 0,
+            last_access REAL DEFAULT 0,
+            checksum TEXT,
+            audio_duration REAL DEFAULT 0,
+            files TEXT
+        )''')
+        # Index cũ: thêm cột checksum/audio_duration/files
+        columns = {row['name'] for row in self.db.execute('PRAGMA table_info(tracks)')}
+        for column, decl in (('checksum', 'TEXT'), ('audio_duration', 'REAL DEFAULT 0'), ('files', 'TEXT')):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE tracks ADD COLUMN {column} {decl}')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS aliases (
+            alias TEXT PRIMARY KEY,
+            track_id TEXT
+        )''')
+        self.touched = {}  # key -> last_access chưa ghi xuống SQLite
+        self.reload()
+        self.data_version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        logger.info(f"Loaded cache index: {len(self.rows)} tracks, {len(self.aliases)} aliases from {path}")
+
+    def reload(self):
+        # Đọc lại toàn bộ (supervisor trước mỗi lượt eviction, các worker ghi cùng file)
+        self.rows = {row['hash']: dict(row) for row in self.db.execute('SELECT * FROM tracks')}
+        self.aliases = dict(self.db.execute('SELECT alias, track_id FROM aliases').fetchall())
+
+    def changed_elsewhere(self):
+        # data_version đổi khi connection khác (prefetch CLI, worker) đã commit
+        version = self.db.execute('PRAGMA data_version').fetchone()[0]
+        changed, self.data_version = version != self.data_version, version
+        return changed
+
+    def refresh(self, key):
+        row = self.db.execute('SELECT * FROM tracks WHERE hash = ?', (key,)).fetchone()
+        if row is None:
+            self.rows.pop(key, None)
+            return None
+        self.rows[key] = dict(row)
+        return self.rows[key]
+
+    def get(self, key):
+        return self.rows.get(key)
+
+    def put(self, key, **fields):
+        fields = {k: v for k, v in fields.items() if k in self.FIELDS}
+        row = self.rows.setdefault(key, {'hash': key, **dict.fromkeys(self.FIELDS)})
+        row.update(fields)
+        columns = ', '.join(fields)
+        placeholders = ', '.join('?' for _ in fields)
+        updates = ', '.join(f"{k} = excluded.{k}" for k in fields)
+        self.db.execute(
+            f"INSERT INTO tracks (hash, {columns}) VALUES (?, {placeholders}) "
+            f"ON CONFLICT(hash) DO UPDATE SET {updates}",
+            (key, *fields.values()))
+
+    def touch(self, key):
+        # Không biết row (worker khác vừa thêm) vẫn ghi: UPDATE không có row thì bỏ qua
+        now = time.time()
+        row = self.rows.get(key)
+        if row is not None:
+            row['last_access'] = now
+        self.touched[key] = now
+
+    def flush_touches(self):
+        if not self.touched:
+            return
+        touched, self.touched = self.touched, {}
+        self.db.executemany('UPDATE tracks SET last_access = ? WHERE hash = ?',
+                            [(last_access, key) for key, last_access in touched.items()])
+
+    def get_alias(self, alias):
+        track_id = self.aliases.get(alias)
+        if track_id is None:
+            # Có thể worker khác vừa ghi alias
+            row = self.db.execute('SELECT track_id FROM aliases WHERE alias = ?', (alias,)).fetchone()
+            if row is not None:
+                track_id = self.aliases[alias] = row[0]
+        return track_id
+
+    def put_alias(self, alias, track_id):
+        if self.aliases.get(alias) != track_id:
+            self.aliases[alias] = track_id
+            self.db.execute('INSERT OR REPLACE INTO aliases (alias, track_id) VALUES (?, ?)', (alias, track_id))
+
+    def delete(self, key):
+        if self.rows.pop(key, None) is not None:
+            self.db.execute('DELETE FROM tracks WHERE hash = ?', (key,))
+
+cache_index = CacheIndex(CACHE_INDEX_PATH)
+
+# Giới hạn dung lượng cache (LRU), xoá tới LOW_WATERMARK khi vượt
+CACHE_MAX_BYTES = 500 * 1024 * 1024
+CACHE_LOW_WATERMARK = 0.8
+CACHE_EXTENSIONS = ('.mp3', '.lrc')  # File chính của một track
+CACHE_SUFFIXES = CACHE_EXTENSIONS + ('.pcm', '.wav', '.jpg', '.png', '.rgb565')  # Mọi file của track (PCM, cover...), xoá cùng nhau
+
+class CacheLRU:
+    """In-memory size/recency accounting for the cache directory.
+
+    Keys are cache hashes; each entry maps the track's file names (mp3, lrc,
+    decoded PCM) to their sizes. The directory is scanned once by load(),
+    then kept up to date by record() on writes and touch() on reads, so
+    eviction never rescans. record() also stores the sizes in the index and
+    touch() bumps last_access there, which is how the supervisor's sync()
+    sees what the workers cached and played.
+    """
+    def __init__(self, cache_dir, max_bytes, low_watermark=CACHE_LOW_WATERMARK):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.entries = OrderedDict()  # key -> {file name: bytes}, oldest first
+        self.total_bytes = 0
+
+    def load(self, index=None):
+        found = {}
+        mtimes = {}
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_SUFFIXES) and entry.is_file():
+                key = entry.name.split('.', 1)[0]
+                st = entry.stat()
+                found.setdefault(key, {})[entry.name] = st.st_size
+                mtimes[key] = max(mtimes.get(key, 0), st.st_mtime)
+        # Thứ tự ban đầu: last_access trong index, nếu không có thì mtime
+        def recency(key):
+            row = index.get(key) if index else None
+            return (row and row['last_access']) or mtimes[key]
+        self.entries = OrderedDict((key, found[key]) for key in sorted(found, key=recency))
+        self.total_bytes = sum(sum(files.values()) for files in self.entries.values())
+        logger.info(f"Cache LRU loaded: {len(self.entries)} tracks, {self.total_bytes / 1024 / 1024:.2f} MB")
+
+    def sync(self, index):
+        """Adopt file sizes and recency other processes wrote to the index (no directory scan)."""
+        for key, row in index.rows.items():
+            if row.get('files'):
+                files = json.loads(row['files'])
+                self.total_bytes += sum(files.values()) - sum(self.entries.get(key, {}).values())
+                self.entries[key] = files
+        # File không có row trong index (lrc/pcm mồ côi) xếp cũ nhất
+        def recency(key):
+            row = index.get(key)
+            return (row and row['last_access']) or 0
+        self.entries = OrderedDict(sorted(self.entries.items(), key=lambda item: recency(item[0])))
+
+    def record(self, key, *names):
+        """Re-measure files of a track after they were written (default: mp3 + lrc)."""
+        if shared_cache:
+            # Worker không load thư mục: sổ chung là row trong index (worker khác có thể vừa thêm file)
+            row = cache_index.refresh(key)
+            files = json.loads(row['files']) if row and row.get('files') else {}
+            self.total_bytes += sum(files.values()) - sum(self.entries.get(key, {}).values())
+        else:
+            files = self.entries.pop(key, {})
+        self.entries.pop(key, None)
+        for name in names or [f"{key}{ext}" for ext in CACHE_EXTENSIONS]:
+            self.total_bytes -= files.pop(name, 0)
+            try:
+                size = os.stat(os.path.join(self.cache_dir, name)).st_size
+            except FileNotFoundError:
+                continue
+            files[name] = size
+            self.total_bytes += size
+        if files:
+            self.entries[key] = files
+        if cache_index.get(key) is not None:
+            cache_index.put(key, files=json.dumps(files))
+
+    def touch(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        cache_index.touch(key)
+
+    def forget(self, key):
+        files = self.entries.pop(key, {})
+        self.total_bytes -= sum(files.values())
+
+    def evict(self, protected=()):
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * self.low_watermark
+        skipped = []
+        while self.total_bytes > target and self.entries:
+            key, files = self.entries.popitem(last=False)
+            if key in protected:
+                skipped.append((key, files))
+                continue
+            size = sum(files.values())
+            self.total_bytes -= size
+            for name in files:
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Cannot delete {path}: {e}")
+            cache_index.delete(key)
+            hot_tier.discard_track(key)
+            logger.info(f"Evicted LRU cache entry {key} ({size / 1024 / 1024:.2f} MB)")
+        # Track đang tải dở giữ nguyên, đưa về cuối hàng
+        for key, files in skipped:
+            self.entries[key] = files
+
+cache_lru = CacheLRU(CACHE_DIR, CACHE_MAX_BYTES)
+
+# FFmpeg pool: số transcode đồng thời theo số core, mỗi job có giới hạn thời gian
+FFMPEG_WORKERS = os.cpu_count() or 2
+FFMPEG_TIMEOUT = 600        # Giây wall-clock tối đa / job
+FFMPEG_CPU_LIMIT = 300      # Giây CPU tối đa / job (RLIMIT_CPU, chỉ Linux)
+
+class FFmpegJobError(RuntimeError):
+    pass
+
+class FFmpegPool:
+    """Run FFmpeg as child processes owned by this server.
+
+    Each job holds one of `workers` slots, is registered by id with its PID,
+    and is limited in wall-clock and CPU time. A failing or timed-out job is
+    killed on its own; other transcodes keep running.
+    """
+    def __init__(self, workers, timeout, cpu_limit):
+        self.workers = workers
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.slots = asyncio.Semaphore(workers)
+        self.jobs = {}  # job id -> asyncio.subprocess.Process
+        self.waiting = 0
+        self.last_job_id = 0
+
+    @property
+    def queue_depth(self):
+        return self.waiting
+
+    def limit_cpu(self, pid):
+        if self.cpu_limit and hasattr(psutil, 'RLIMIT_CPU'):
+            try:
+                psutil.Process(pid).rlimit(psutil.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit + 5))
+            except psutil.Error as e:
+                logger.warning(f"Cannot set CPU limit on FFmpeg PID {pid}: {e}")
+
+    @contextlib.asynccontextmanager
+    async def spawn(self, args, label='', **kwargs):
+        self.last_job_id += 1
+        job_id = self.last_job_id
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            kwargs.setdefault('stdin', asyncio.subprocess.DEVNULL)
+            proc = await asyncio.create_subprocess_exec('ffmpeg', '-hide_banner', '-nostdin', *args, **kwargs)
+            self.jobs[job_id] = proc
+            self.limit_cpu(proc.pid)
+            logger.info(f"FFmpeg job {job_id} ({label}) started, PID {proc.pid}, running {len(self.jobs)}, queued {self.waiting}")
+            try:
+                yield proc
+            finally:
+                self.jobs.pop(job_id, None)
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                    logger.info(f"Killed FFmpeg job {job_id} ({label}) PID {proc.pid}")
+        finally:
+            self.slots.release()
+
+    async def run(self, args, label='', timeout=None):
+        """Run one FFmpeg command to completion and return its stdout."""
+        timeout = timeout or self.timeout
+        async with self.spawn(args, label, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE) as proc:
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                raise FFmpegJobError(f"FFmpeg job {label} timed out after {timeout}s")
+            if proc.returncode != 0:
+                raise FFmpegJobError(f"FFmpeg job {label} failed (rc={proc.returncode}): {stderr.decode(errors='replace')[-300:]}")
+            return stdout
+
+ffmpeg_pool = FFmpegPool(FFMPEG_WORKERS, FFMPEG_TIMEOUT, FFMPEG_CPU_LIMIT)
+
+# Single-flight theo cache_filename (generate_hash): mỗi bài chỉ search + download một lần
+inflight_metadata = {}   # cache_filename -> asyncio.Task (metadata của leader)
+inflight_downloads = {}  # cache_filename -> DownloadJob (đang chờ hoặc đang tải)
+
+# Hàng đợi download có ưu tiên (số nhỏ chạy trước)
+PRIORITY_USER = 0        # Bài người dùng vừa yêu cầu
+PRIORITY_PREFETCH = 10   # Prefetch playlist
+PRIORITY_WARMUP = 20     # Warm-up cache
+DOWNLOAD_QUEUE_MAX = 50  # Số job tối đa đang chờ
+JOB_HISTORY_TTL = 600    # Giữ trạng thái job đã xong cho /status (giây)
+PROGRESS_POLL_INTERVAL = 0.5
+
+# Progressive streaming: FFmpeg transcode phát cho client ngay khi có dữ liệu
+LIVE_CHUNK_SIZE = 16 * 1024
+LIVE_READ_TIMEOUT = 20      # Giây không có dữ liệu từ FFmpeg thì huỷ
+LIVE_WINDOW_BYTES = 1024 * 1024  # Phần đuôi giữ trong RAM; client tụt xa hơn đọc lại từ file tee
+live_streams = {}           # tên rendition MP3 -> LiveStream
+pcm_streams = {}            # tên file PCM -> LiveStream (decode PCM/ADPCM)
+rendition_encodes = {}      # tên rendition -> Task khởi động encode rendition còn thiếu
+
+# Raw PCM / IMA ADPCM cho stream_pcm: decode một lần trên server, cache theo format
+PCM_SAMPLE_RATES = (8000, 11025, 16000, 22050, 32000, 44100, 48000)
+PCM_DEFAULT_SAMPLE_RATE = 22050
+
+class TTLCache:
+    """Small in-memory cache with per-entry expiry and an LRU size cap."""
+    def __init__(self, ttl, max_items):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+# Kết quả search dùng lại cho download: query -> video id, video id -> info (URL stream hết hạn sau vài giờ)
+VIDEO_ID_TTL = 24 * 3600
+INFO_TTL = 30 * 60
+video_id_cache = TTLCache(VIDEO_ID_TTL, 4096)  # query alias -> video id
+info_cache = TTLCache(INFO_TTL, 64)            # video id -> info dict đã resolve format
+
+# /search: ytsearchN (flat) chạy ở extract_pool, kết quả cache TTL trong RAM + SQLite
+SEARCH_RESULTS = 10          # Luôn lấy đủ N kết quả, cắt theo limit khi trả về
+SEARCH_DEFAULT_LIMIT = 5
+SEARCH_TTL = 6 * 3600
+SEARCH_MIN_PREFIX = 3        # Độ dài tối thiểu của query tiền tố được dùng lại
+
+class SearchCache:
+    """Search results keyed by normalized query, in memory and in SQLite."""
+    def __init__(self, db, ttl, max_items):
+        self.db = db
+        self.ttl = ttl
+        self.memory = TTLCache(ttl, max_items)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS search_cache (
+            query TEXT PRIMARY KEY,
+            results TEXT,
+            created REAL
+        )''')
+        self.db.execute('DELETE FROM search_cache WHERE created < ?', (time.time() - ttl,))
+
+    def get(self, query):
+        results = self.memory.get(query)
+        if results is None:
+            row = self.db.execute('SELECT results, created FROM search_cache WHERE query = ?', (query,)).fetchone()
+            if row is not None and row['created'] + self.ttl > time.time():
+                results = json.loads(row['results'])
+                self.memory.set(query, results)
+        return results
+
+    def put(self, query, results):
+        self.memory.set(query, results)
+        self.db.execute('INSERT OR REPLACE INTO search_cache (query, results, created) VALUES (?, ?, ?)',
+                        (query, json.dumps(results, ensure_ascii=False), time.time()))
+
+    def prefix_match(self, query):
+        """Filter the results of the longest cached prefix of `query` (incremental typing)."""
+        words = query.split()
+        for end in range(len(query) - 1, SEARCH_MIN_PREFIX - 1, -1):
+            results = self.memory.get(query[:end])
+            if results is None:
+                continue
+            matches = [r for r in results
+                       if all(w in f"{r['title']} {r['artist']}".lower() for w in words)]
+            return matches or None
+        return None
+
+search_cache = SearchCache(cache_index.db, SEARCH_TTL, 512)
+inflight_searches = {}  # normalized query -> asyncio.Task
+
+# Executor cho các tác vụ blocking (yt-dlp, FFmpeg) để không chặn event loop
+EXTRACT_WORKERS = 4         # Thread pool cho extract_info
+EXTRACT_QUEUE_LIMIT = 16    # Số job extract tối đa (đang chạy + đang chờ)
+DOWNLOAD_WORKERS = 3        # Process pool cho yt-dlp download (transcode chạy ở ffmpeg_pool)
+DOWNLOAD_QUEUE_LIMIT = 32   # Số job download tối đa (đang chạy + đang chờ)
+
+# Multi-process: >1 thì pre-fork SERVER_WORKERS process cùng cổng (SO_REUSEPORT, chỉ POSIX)
+SERVER_WORKERS = 1
+EVICT_INTERVAL = 30         # giây, supervisor kiểm tra dung lượng cache chung
+shared_cache = False        # True trong worker: cache dùng chung, supervisor lo eviction
+
+class ExecutorBusyError(RuntimeError):
+    pass
+
+class BoundedExecutor:
+    """Wrap a concurrent.futures executor with a cap on pending jobs.
+
+    Jobs beyond `queue_limit` are rejected with ExecutorBusyError instead of
+    piling up, so a burst of misses cannot grow the backlog without bound.
+    """
+    def __init__(self, name, executor, queue_limit):
+        self.name = name
+        self.executor = executor
+        self.queue_limit = queue_limit
+        self.pending = 0
+
+    async def run(self, func, *args, **kwargs):
+        if self.pending >= self.queue_limit:
+            raise ExecutorBusyError(f"{self.name} executor busy ({self.pending} pending)")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+extract_pool = BoundedExecutor(
+    'extract', ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix='extract'), EXTRACT_QUEUE_LIMIT)
+download_pool = BoundedExecutor(
+    'download', ProcessPoolExecutor(max_workers=DOWNLOAD_WORKERS), DOWNLOAD_QUEUE_LIMIT)
+
+# Metrics dạng Prometheus text cho /metrics (RSS lấy mẫu định kỳ, không đo trên đường request)
+METRICS_RSS_INTERVAL = 15  # giây
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Counter:
+    """Prometheus counter with one series per tuple of label values."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+class Histogram(Counter):
+    """Prometheus histogram; `time()` observes the duration of a with-block."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labels, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+stage_seconds = Histogram('music_stage_duration_seconds', 'Latency per stage (auth, metadata, extract, search, download, transcode, static)', ('stage',))
+cache_lookups = Counter('music_cache_lookups_total', 'Cache lookups by cache and result', ('cache', 'result'))
+bytes_served = Counter('music_bytes_served_total', 'Response body bytes served per route', ('route',))
+queue_depth = Gauge('music_queue_depth', 'Jobs pending per queue', ('queue',))
+rss_bytes = Gauge('music_process_resident_memory_bytes', 'Resident set size, sampled every METRICS_RSS_INTERVAL seconds')
+METRICS = [stage_seconds, cache_lookups, bytes_served, queue_depth, rss_bytes]
+
+async def sample_memory():
     process = psutil.Process()
-    memory_mb = process.memory_info().rss / 1024 / 1024
-    logger.info(f"{prefix} Memory usage: {memory_mb:.2f} MB")
+    while True:
+        rss_bytes.set(process.memory_info().rss)
+        await asyncio.sleep(METRICS_RSS_INTERVAL)
+
+async def flush_index_touches():
+    while True:
+        await asyncio.sleep(INDEX_TOUCH_FLUSH_INTERVAL)
+        cache_index.flush_touches()
+
+def normalize_query(query):
+    return query.lower().strip()
 
 def generate_hash(query):
-    normalized = query.lower().strip()
+    normalized = normalize_query(query)
     return hashlib.sha256(normalized.encode()).hexdigest()[:32]
 
+# Từ thừa trong query (đã bỏ dấu), không ảnh hưởng tới bài được chọn
+QUERY_NOISE_WORDS = {
+    'official', 'mv', 'music', 'video', 'audio', 'lyric', 'lyrics', 'hd', '4k', 'full',
+    'ft', 'feat', 'bai', 'hat', 'nhac', 'cua',
+}
+
+def fold_diacritics(text):
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+
+def canonical_query(query):
+    """Order-insensitive canonical form: 'Son Tung - Lạc Trôi (Official MV)' -> 'lac son troi tung'."""
+    words = re.sub(r'[^\w\s]', ' ', fold_diacritics(query).lower()).split()
+    kept = [w for w in words if w not in QUERY_NOISE_WORDS] or words
+    return ' '.join(sorted(set(kept)))
+
+def query_alias(query):
+    # Khoá alias của query; file cache lưu theo video id mà alias trỏ tới
+    return generate_hash(canonical_query(query))
+
 def parse_artist_from_title(title, query_artist=''):
     if query_artist and query_artist.strip():
         return query_artist.strip()
@@ -94,92 +670,67 @@ def verify_auth(request):
 
 async def auth_middleware(app, handler):
     async def middleware(request):
-        if request.path.startswith('/music_cache/'):
+        # /live khởi động FFmpeg và có thể kéo nguồn từ YouTube: cần auth như /stream_pcm
+        if request.path.startswith(('/music_cache/', '/cover/')) or request.path == '/metrics':
             return await handler(request)
         
-        if not verify_auth(request):
+        with stage_seconds.time('auth'):
+            authorized = verify_auth(request)
+        if not authorized:
             return web.json_response({'error': 'Unauthorized'}, status=401)
         
         return await handler(request)
     return middleware
 
 def cleanup_temp_files(cache_filename):
-    temp_extensions = ['.part', '.ytdl', '.webm', '.m4a', '.tmp']
+    temp_extensions = ['.part', '.ytdl', '.webm', '.m4a', '.opus', '.webm.part', '.m4a.part', '.tmp', '.mp3.transcode.tmp']
     for ext in temp_extensions:
         temp_path = os.path.join(CACHE_DIR, f"{cache_filename}{ext}")
         if os.path.exists(temp_path):
             os.remove(temp_path)
             logger.info(f"Cleaned temp file: {temp_path}")
 
-def kill_ffmpeg_processes():
-    for proc in psutil.process_iter(['pid', 'name']):
-        if 'ffmpeg' in proc.info['name'].lower():
-            proc.kill()
-            logger.info(f"Killed hanging FFmpeg PID {proc.info['pid']}")
+# Fallback audio: beep + silence encode một lần lúc khởi động, giữ trong RAM
+FALLBACK_BEEP_SECONDS = 3
+FALLBACK_SILENCE_SECONDS = 3
+fallback_audio = b''  # MP3 frames không có tag
+
+def fallback_audio_args(beep_seconds=FALLBACK_BEEP_SECONDS, silence_seconds=FALLBACK_SILENCE_SECONDS):
+    """Loud beep (440Hz, -5dB) + silence, raw MP3 frames to stdout."""
+    return [
+        '-f', 'lavfi', '-t', str(beep_seconds), '-i', 'sine=frequency=440',
+        '-f', 'lavfi', '-t', str(silence_seconds), '-i', 'anullsrc=r=22050:cl=mono',
+        '-filter_complex',
+        '[0:a]volume=-5dB,aresample=22050,aformat=channel_layouts=mono[beep];'
+        '[1:a]aresample=22050,aformat=channel_layouts=mono[silence];'
+        '[beep][silence]concat=n=2:v=0:a=1',
+        '-c:a', 'mp3', '-b:a', '96k',
+        '-id3v2_version', '0', '-write_xing', '0',
+        '-loglevel', 'error',
+        '-f', 'mp3', 'pipe:1',
+    ]
 
-def create_fallback_mp3(mp3_path, title, artist, duration=180):
-    """Tạo fallback MP3 with FFmpeg: silence + loud beep, add ID3 tag."""
+async def load_fallback_audio():
+    global fallback_audio
     try:
-        # Create silence full
-        silence_path = mp3_path + '.silence.tmp'
-        cmd_silence = [
-            'ffmpeg', '-y',
-            '-f', 'lavfi', '-i', 'anullsrc=r=44100:cl=stereo',
-            '-t', str(duration),
-            '-ar', '22050', '-ac', '1',
-            '-c:a', 'mp3', '-b:a', '96k',
-            '-loglevel', 'quiet',
-            silence_path
-        ]
-        subprocess.run(cmd_silence, capture_output=True, timeout=30)
-        
-        # Create loud beep (440Hz, 3s, volume -5dB)
-        beep_path = mp3_path + '.beep.tmp'
-        cmd_beep = [
-            'ffmpeg', '-y',
-            '-f', 'lavfi', '-i', 'sine=frequency=440:duration=3',
-            '-af', 'volume=-5dB',  # Loud but not distort
-            '-ar', '22050', '-ac', '1',
-            '-c:a', 'mp3', '-b:a', '96k',
-            '-loglevel', 'quiet',
-            beep_path
-        ]
-        subprocess.run(cmd_beep, capture_output=True, timeout=10)
-        
-        # Concat beep + silence
-        cmd_concat = [
-            'ffmpeg', '-y',
-            '-i', beep_path,
-            '-i', silence_path,
-            '-filter_complex', 'concat=n=2:v=0:a=1',
-            '-c:a', 'mp3', '-b:a', '96k',
-            '-loglevel', 'quiet',
-            mp3_path
-        ]
-        result = subprocess.run(cmd_concat, capture_output=True, text=True, timeout=60)
-        
-        # Cleanup temp
-        for tmp in [silence_path, beep_path]:
-            if os.path.exists(tmp):
-                os.remove(tmp)
-        
-        # Add ID3 tag
-        if os.path.exists(mp3_path):
-            audio = MP3(mp3_path)
-            audio.tags.add(MP3.ADDR.TIT2, title)
-            audio.tags.add(MP3.ADDR.TPE1, artist)
-            audio.save()
-        
-        if result.returncode == 0:
-            size = os.path.getsize(mp3_path) / 1024 / 1024
-            logger.info(f"Created FFmpeg fallback beep + silence MP3 ({duration}s, size {size:.2f} MB): {mp3_path}")
-            return True
-        else:
-            logger.error(f"FFmpeg fallback fail: {result.stderr}")
-            return False
+        fallback_audio = await ffmpeg_pool.run(fallback_audio_args(), label='fallback', timeout=30)
+        logger.info(f"Fallback beep + silence MP3 ready in memory ({len(fallback_audio) / 1024:.1f} KB)")
     except Exception as e:
         logger.error(f"Fallback MP3 error: {e}")
-        return False
+
+def syncsafe(n):
+    return bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f])
+
+def build_id3_header(title, artist):
+    """Minimal ID3v2.4 tag with UTF-8 TIT2/TPE1 frames."""
+    frames = b''
+    for frame_id, text in (('TIT2', title), ('TPE1', artist)):
+        body = b'\x03' + text.encode('utf-8')
+        frames += frame_id.encode() + syncsafe(len(body)) + b'\x00\x00' + body
+    return b'ID3\x04\x00\x00' + syncsafe(len(frames)) + frames
+
+def fallback_mp3(title, artist):
+    return build_id3_header(title, artist) + fallback_audio
 
 def create_fallback_lyrics(title, artist, lrc_path):
     fallback = f"""[00:00.00]Lyrics for {title} by {artist}
@@ -187,154 +738,1049 @@ def create_fallback_lyrics(title, artist, lrc_path):
 [01:00.00]Chorus: Điệp khúc vang vọng...
 [02:00.00]Verse 2: Tiếp tục...
 [03:00.00]Kết thúc bài hát."""
-    with open(lrc_path, 'w', encoding='utf-8') as f:
+    tmp_path = f"{lrc_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         f.write(fallback)
+    os.replace(tmp_path, lrc_path)
+    hot_tier.discard(os.path.basename(lrc_path))
     logger.info(f"Created fallback lyrics: {lrc_path}")
 
-# Xoá cache cũ nếu vượt quá 500 MB
-async def cleanup_old_cache(max_size_mb=500):
-    total_size = 0
-    files = []
-    for name in os.listdir(CACHE_DIR):
-        path = os.path.join(CACHE_DIR, name)
-        if os.path.isfile(path):
-            size = os.path.getsize(path)
-            total_size += size
-            files.append((path, size, os.path.getmtime(path)))
-    total_size_mb = total_size / 1024 / 1024
-    if total_size_mb > max_size_mb:
-        files.sort(key=lambda x: x[2])  # sort by mtime
-        while total_size_mb > max_size_mb * 0.8 and files:
-            f, s, _ = files.pop(0)
-            try:
-                os.remove(f)
-                total_size_mb -= s / 1024 / 1024
-                logger.info(f"Deleted old cache: {f}")
-            except:
-                pass
+# Chạy trong executor (blocking)
+def ydl_extract_info(query, ydl_opts):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(query, download=False)
+        # ytsearch1: trả về playlist, metadata thật nằm trong entries[0]
+        if info.get('entries'):
+            info = info['entries'][0]
+        # JSON-safe để truyền sang process pool / dùng lại khi download
+        return ydl.sanitize_info(info)
 
+def ydl_search(query, count, ydl_opts):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(f"ytsearch{count}:{query}", download=False)
+        return [ydl.sanitize_info(entry) for entry in info.get('entries') or [] if entry]
 
-async def background_download(full_query, cache_filename, title, artist, duration):
-    async with background_semaphore:
-        log_memory("Before background download")
-        mp3_path = os.path.join(CACHE_DIR, f"{cache_filename}.mp3")
-        lrc_path = os.path.join(CACHE_DIR, f"{cache_filename}.lrc")
-        
-        if os.path.exists(mp3_path) and os.path.getsize(mp3_path) > 100000:
-            logger.info(f"Cache hit, skipping background for {title}")
-            return
-        
-        logger.info(f"Starting background download for {full_query}")
-        
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': os.path.join(CACHE_DIR, f"{cache_filename}.%(ext)s"),
-            'http_headers': YOUTUBE_HEADERS,
-            'noplaylist': True,
-            'quiet': True,
-            'no_warnings': True,
-            'retries': 2,
-            'fragment_retries': 2,
-            'socket_timeout': 10,
-            'geo_bypass': True,
-            'no_cache_dir': True,
-            'sleep_interval': 1,
-            'max_sleep_interval': 3,
-            'extractor_args': {
-                'youtube': {'player_skip': 'js', 'skip': ['dash', 'hls']},
-            },
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                #'preferredquality': '96',
-                'preferredquality': '64',
-            }],
-            'postprocessor_args': {
-                'FFmpegExtractAudio': ['-ar', '22050', '-ac', '1', '-vn'],
-            },
-        }
-        old_size = os.path.getsize(mp3_path) if os.path.exists(mp3_path) else 0
+def downloaded_filepath(info):
+    if info.get('entries'):
+        info = info['entries'][0]
+    return info['requested_downloads'][0]['filepath']
+
+def ydl_download(query, ydl_opts):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return downloaded_filepath(ydl.extract_info(query, download=True))
+
+def ydl_download_info(info, ydl_opts):
+    # Như --load-info-json: tải từ info đã extract, không search/resolve lại
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return downloaded_filepath(ydl.process_ie_result(info, download=True))
+
+LIVE_ABORT_CHECK_INTERVAL = 1  # giây giữa hai lần progress hook tìm file tee của live stream
+live_abort_checks = {}  # (trong process tải) cache_filename -> lần kiểm tra gần nhất
+
+def abort_if_live(cache_filename, status):
+    """yt-dlp progress hook: stop the download once a live stream is teeing the same track into the cache."""
+    now = time.monotonic()
+    if now - live_abort_checks.get(cache_filename, 0) < LIVE_ABORT_CHECK_INTERVAL:
+        return
+    live_abort_checks[cache_filename] = now
+    # File tee <track>.mp3.<pid>.live.tmp: thấy được cả live stream của worker khác
+    if glob.glob(os.path.join(CACHE_DIR, f"{glob.escape(rendition_name(cache_filename))}.*.live.tmp")):
+        raise yt_dlp.utils.DownloadCancelled(f"live stream took over {cache_filename}")
+
+def discard_download(cache_filename, future):
+    # yt-dlp của job đã bị live stream thay thế vẫn chạy tới progress hook kế tiếp: dọn những gì nó để lại
+    if not future.cancelled() and future.exception() is None:
+        source_path = future.result()
+        if not source_path.endswith('.mp3') and os.path.exists(source_path):
+            os.remove(source_path)
+    cleanup_temp_files(cache_filename)
+
+# Profile chất lượng theo thiết bị (header X-Audio-Profile hoặc ?quality=).
+# 'standard' = 64 kbps, 22050 Hz mono như FFmpegExtractAudio cũ, file <track>.mp3;
+# profile khác lưu cạnh nó: <track>.<profile>.mp3 (cùng entry LRU, cùng ngân sách dung lượng)
+AUDIO_PROFILES = {
+    'low': {'bitrate': 32, 'rate': 16000, 'channels': 1},
+    'standard': {'bitrate': 64, 'rate': 22050, 'channels': 1},
+    'high': {'bitrate': 128, 'rate': 44100, 'channels': 2},
+}
+DEFAULT_PROFILE = 'standard'
+RENDITION_PATTERN = r'[A-Za-z0-9_-]+(?:\.(?:' + '|'.join(p for p in AUDIO_PROFILES if p != DEFAULT_PROFILE) + r'))?\.mp3'
+
+def profile_encode_args(profile):
+    spec = AUDIO_PROFILES[profile]
+    return ['-vn', '-ar', str(spec['rate']), '-ac', str(spec['channels']),
+            '-c:a', 'libmp3lame', '-b:a', f"{spec['bitrate']}k", '-f', 'mp3']
+
+MP3_ENCODE_ARGS = profile_encode_args(DEFAULT_PROFILE)
+
+def rendition_name(cache_filename, profile=DEFAULT_PROFILE):
+    if profile == DEFAULT_PROFILE:
+        return f"{cache_filename}.mp3"
+    return f"{cache_filename}.{profile}.mp3"
+
+def split_rendition(name):
+    cache_filename, _, profile = name[:-len('.mp3')].partition('.')
+    return cache_filename, profile or DEFAULT_PROFILE
+
+def has_rendition(cache_filename, profile):
+    if profile == DEFAULT_PROFILE:
+        return has_cached_mp3(cache_filename)
+    # Rendition phụ luôn được ghi atomic: có file là đủ
+    return os.path.exists(os.path.join(CACHE_DIR, rendition_name(cache_filename, profile)))
+
+def best_cached_rendition(cache_filename, min_profile=None):
+    """Best cached profile of a track that is at least as good as `min_profile`."""
+    floor = AUDIO_PROFILES[min_profile]['bitrate'] if min_profile else 0
+    for profile in sorted(AUDIO_PROFILES, key=lambda p: AUDIO_PROFILES[p]['bitrate'], reverse=True):
+        if AUDIO_PROFILES[profile]['bitrate'] >= floor and has_rendition(cache_filename, profile):
+            return profile
+    return None
+
+def negotiate_profile(request):
+    profile = (request.headers.get('X-Audio-Profile') or request.query.get('quality', '')).lower()
+    return profile if profile in AUDIO_PROFILES else DEFAULT_PROFILE
+
+def transcode_args(source_path, outputs):
+    # Decode một lần, encode mọi rendition: outputs = [(profile, path), ...]
+    args = ['-y', '-loglevel', 'error', '-i', source_path]
+    for profile, output_path in outputs:
+        args += [*profile_encode_args(profile), output_path]
+    return args
+
+def url_input_args(source_url, http_headers):
+    headers = ''.join(f"{k}: {v}\r\n" for k, v in (http_headers or {}).items())
+    return [
+        '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5',
+        '-headers', headers,
+        '-i', source_url,
+    ]
+
+# Ghi cache an toàn khi crash: ghi ra file tạm, fsync, rồi os.replace vào chỗ
+TRUNCATED_RATIO = 0.9     # MP3 ngắn hơn 90% duration của YouTube coi như bị cắt
+RECOVERY_WORKERS = 4      # Số file kiểm tra song song lúc khởi động
+ORPHAN_SUFFIXES = ('.part', '.ytdl', '.tmp', '.webm', '.m4a', '.opus')  # gồm .live.tmp, .transcode.tmp
+
+LOCK_POLL_INTERVAL = 0.5  # giây, chờ khoá track của worker khác
+
+def commit_file(tmp_path, path):
+    """fsync a finished temp file and atomically rename it onto `path` (blocking)."""
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([f"ytsearch1:{full_query}"])
-            # Rename
-            for ext in ['mp3', 'webm', 'm4a']:
-                temp_path = os.path.join(CACHE_DIR, f"{cache_filename}.{ext}")
-                if os.path.exists(temp_path):
-                    os.rename(temp_path, mp3_path)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def inspect_mp3(mp3_path):
+    """Size, sha256 and mutagen-measured duration/bitrate of an MP3 (blocking)."""
+    digest = hashlib.sha256()
+    with open(mp3_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    try:
+        info = MP3(mp3_path).info
+        length, bitrate = info.length, info.bitrate
+    except Exception as e:
+        logger.warning(f"Cannot read MP3 info of {mp3_path}: {e}")
+        length, bitrate = 0, 0
+    return {'file_size': os.path.getsize(mp3_path), 'checksum': digest.hexdigest(),
+            'audio_duration': length, 'bitrate': bitrate}
+
+def verify_cached_mp3(mp3_path, row):
+    """Return fresh inspect_mp3() facts if the file is healthy, None if corrupt or truncated."""
+    facts = inspect_mp3(mp3_path)
+    if not facts['audio_duration']:
+        return None
+    if row and row.get('checksum'):
+        return facts if facts['checksum'] == row['checksum'] else None
+    # File chưa có checksum (cache cũ): so độ dài với duration của YouTube
+    if row and row.get('duration') and facts['audio_duration'] < row['duration'] * TRUNCATED_RATIO:
+        return None
+    return facts
+
+def has_cached_mp3(cache_filename):
+    try:
+        size = os.stat(os.path.join(CACHE_DIR, f"{cache_filename}.mp3")).st_size
+    except FileNotFoundError:
+        return False
+    row = cache_index.get(cache_filename)
+    if shared_cache and (row is None or size != row['file_size']):
+        row = cache_index.refresh(cache_filename)  # worker khác vừa ghi file
+    if row and row['checksum']:
+        return size == row['file_size']
+    return size > 100000
+
+@contextlib.asynccontextmanager
+async def track_lock(cache_filename):
+    """Exclusive cross-process lock on one track (flock on CACHE_DIR/<key>.lock)."""
+    if fcntl is None:
+        yield
+        return
+    path = os.path.join(CACHE_DIR, f"{cache_filename}.lock")
+    waiting = False
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
                     break
-            cleanup_temp_files(cache_filename)
-            new_size = os.path.getsize(mp3_path)
-            logger.info(f"Background real MP3 downloaded, overwrote ({old_size/1024/1024:.2f} -> {new_size/1024/1024:.2f} MB): {mp3_path}")
-        except Exception as e:
-            logger.error(f"Background download failed: {e}")
-            cleanup_temp_files(cache_filename)
-            kill_ffmpeg_processes()
-        
-        log_memory("After background download")
-        gc.collect()
-        await cleanup_old_cache()
+                except BlockingIOError:
+                    if not waiting:
+                        logger.info(f"{cache_filename} is locked by another worker, waiting")
+                        waiting = True
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+            # Chủ trước xoá file khoá trước khi nhả: khoá trên inode cũ không còn giá trị, mở lại
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+        except BaseException:
+            os.close(fd)
+            raise
+        if current:
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        # File khoá chỉ tồn tại khi track đang được tải/transcode
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        os.close(fd)  # đóng fd là nhả khoá
 
-    if not os.path.exists(lrc_path):
-        create_fallback_lyrics(title, artist, lrc_path)
+def lock_held(path, remove_stale=False):
+    # Thử flock không chờ: bận = có process (kể cả chính process này) đang giữ khoá
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if remove_stale:
+            os.remove(path)  # xoá trong lúc giữ khoá, như track_lock
+        return False
+    except BlockingIOError:
+        return True
+    except FileNotFoundError:
+        return False
+    finally:
+        os.close(fd)
 
-async def get_music_metadata(full_query, cache_filename, query_artist=''):
+def track_locked(cache_filename):
+    return fcntl is not None and lock_held(os.path.join(CACHE_DIR, f"{cache_filename}.lock"))
+
+def locked_tracks():
+    # Track đang được worker nào đó tải/transcode (không evict); file khoá bỏ lại (process chết) thì xoá
+    locked = set()
+    if fcntl is None:
+        return locked
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith('.lock') and lock_held(os.path.join(CACHE_DIR, name), remove_stale=True):
+            locked.add(name[:-len('.lock')])
+    return locked
+
+def track_pending(cache_filename):
+    """True while the track is being fetched by this process or, with a shared cache, maybe by another one."""
+    if cache_filename in inflight_downloads or rendition_name(cache_filename) in live_streams:
+        return True
+    # SO_REUSEPORT: request có thể rơi vào worker không giữ job; khoá track = đang tải ở process khác
+    if track_locked(cache_filename):
+        return True
+    return shared_cache and (cache_index.get(cache_filename) or cache_index.refresh(cache_filename)) is not None
+
+async def register_cached_mp3(cache_filename):
     mp3_path = os.path.join(CACHE_DIR, f"{cache_filename}.mp3")
+    facts = await asyncio.to_thread(inspect_mp3, mp3_path)
+    cache_index.put(cache_filename, **facts, last_access=time.time())
+    cache_lru.record(cache_filename)
+    return facts['file_size']
+
+async def recover_cache():
+    """Startup scan: purge download/transcode debris and corrupt MP3s, adopt untracked files."""
+    semaphore = asyncio.Semaphore(RECOVERY_WORKERS)
+
+    async def check(name, path):
+        key, profile = split_rendition(name)
+        row = cache_index.get(key)
+        primary = profile == DEFAULT_PROFILE
+        # Rendition phụ không có checksum riêng: chỉ kiểm tra mutagen + duration của track
+        expected = row if primary else {'duration': row['duration']} if row else None
+        async with semaphore:
+            facts = await asyncio.to_thread(verify_cached_mp3, path, expected)
+        if facts is None:
+            logger.warning(f"Removing corrupt or truncated cache file: {path}")
+            os.remove(path)
+            if primary and row is not None:
+                cache_index.put(key, file_size=0, bitrate=0, checksum=None, audio_duration=0)
+            return False
+        if primary:
+            cache_index.put(key, **facts)
+        return True
+
+    checks = []
+    orphans = 0
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.is_file():
+            continue
+        if entry.name.endswith(ORPHAN_SUFFIXES):
+            os.remove(entry.path)
+            orphans += 1
+        elif entry.name.endswith('.mp3'):
+            checks.append(check(entry.name, entry.path))
+    healthy = sum(await asyncio.gather(*checks))
+    locked_tracks()  # dọn file khoá của lần chạy trước
+    logger.info(f"Cache recovery: {healthy} healthy MP3, {len(checks) - healthy} removed, {orphans} orphan files purged")
+
+# Xoá cache LRU nếu vượt quá CACHE_MAX_BYTES (không quét lại thư mục)
+async def cleanup_old_cache():
+    # Chế độ multi-process: supervisor giữ sổ dung lượng chung và evict định kỳ
+    if not shared_cache:
+        # Prefetch CLI chạy song song chỉ ghi index: nhận sổ của nó trước khi evict
+        if cache_index.changed_elsewhere():
+            cache_index.flush_touches()
+            cache_index.reload()
+            cache_lru.sync(cache_index)
+        cache_lru.evict(protected=inflight_downloads)
+
+def expected_source_size(info):
+    if not info:
+        return 0
+    size = info.get('filesize') or info.get('filesize_approx')
+    if not size and info.get('duration') and info.get('abr'):
+        size = info['duration'] * info['abr'] * 1000 / 8
+    return size or 0
+
+async def watch_progress(job, paths, expected_size, start, end):
+    # Ước lượng tiến độ theo kích thước file đang ghi, không cần IPC với process pool
+    while True:
+        size = 0
+        for path in paths:
+            try:
+                size = max(size, os.stat(path).st_size)
+            except FileNotFoundError:
+                pass
+        if expected_size:
+            job.set_progress(start + (end - start) * min(size / expected_size, 1.0))
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+
+async def background_download(job):
+    cache_filename = job.cache_filename
+    
+    # Khoá theo track: hai worker không bao giờ tải cùng một bài
+    async with track_lock(cache_filename):
+        if has_cached_mp3(cache_filename):
+            logger.info(f"Cache hit, skipping background for {job.title}")
+            return
+        await download_track(job)
+    
+    await finish_download(job)
+
+async def finish_download(job):
+    # Sau khi có <track>.mp3 (tải xong hoặc live stream tee xong): evict + lyrics dự phòng
+    cache_filename = job.cache_filename
     lrc_path = os.path.join(CACHE_DIR, f"{cache_filename}.lrc")
+    await cleanup_old_cache()
     
-    from_cache = os.path.exists(mp3_path) and os.path.getsize(mp3_path) > 100000
-    title = full_query
-    artist = query_artist or 'Unknown'
-    duration = 180
-    cover_url = "http://y.gtimg.cn/music/photo_new/T002R300x300M000004AfbeH1xUvTe.jpg"
+    if not os.path.exists(lrc_path):
+        create_fallback_lyrics(job.title, job.artist, lrc_path)
+        cache_lru.record(cache_filename)
+
+async def download_track(job):
+    full_query, cache_filename, video_id = job.full_query, job.cache_filename, job.video_id
+    mp3_path = os.path.join(CACHE_DIR, f"{cache_filename}.mp3")
+    logger.info(f"Starting background download for {full_query}")
     
-    if from_cache:
-        size = os.path.getsize(mp3_path) / 1024 / 1024
-        logger.info(f"Cache hit ({size:.2f} MB): {mp3_path}")
-    else:
-        logger.info(f"Cache miss, creating fallback full duration for {full_query}")
+    # Chỉ tải audio gốc; transcode sang MP3 do ffmpeg_pool đảm nhiệm
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(CACHE_DIR, f"{cache_filename}.%(ext)s"),
+        'http_headers': YOUTUBE_HEADERS,
+        'noplaylist': True,
+        'quiet': True,
+        'no_warnings': True,
+        'retries': 2,
+        'fragment_retries': 2,
+        'socket_timeout': 10,
+        'geo_bypass': True,
+        'no_cache_dir': True,
+        'sleep_interval': 1,
+        'max_sleep_interval': 3,
+        'extractor_args': {
+            'youtube': {'player_skip': 'js', 'skip': ['dash', 'hls']},
+        },
+    }
+    if job.ratelimit:
+        ydl_opts['ratelimit'] = job.ratelimit  # bytes/s, job prefetch/warm-up
+    ydl_opts['progress_hooks'] = [functools.partial(abort_if_live, cache_filename)]
+    progress = None
+    outputs = []
+    try:
+        job.set_state('downloading')
+        info = info_cache.get(video_id) if video_id else None
+        exts = {info.get('ext') if info else None, 'webm', 'm4a'} - {None}
+        part_paths = [os.path.join(CACHE_DIR, f"{cache_filename}.{ext}{suffix}") for ext in exts for suffix in ('.part', '')]
+        progress = asyncio.create_task(watch_progress(job, part_paths, expected_source_size(info), 0, 80))
+        if info is not None:
+            download = asyncio.ensure_future(download_pool.run(ydl_download_info, info, ydl_opts))
+        elif video_id:
+            download = asyncio.ensure_future(download_pool.run(ydl_download, youtube_watch_url(video_id), ydl_opts))
+        else:
+            download = asyncio.ensure_future(download_pool.run(ydl_download, f"ytsearch1:{full_query}", ydl_opts))
+        try:
+            with stage_seconds.time('download'):
+                source_path = await asyncio.shield(download)
+        except asyncio.CancelledError:
+            # Live stream nhận việc (DownloadScheduler.hand_over): process tải không huỷ được từ đây
+            download.add_done_callback(functools.partial(discard_download, cache_filename))
+            raise
+        progress.cancel()
         
-        # FFmpeg fallback
-        #create_fallback_mp3(mp3_path, duration, title, artist)  # Add ID3
-        create_fallback_mp3(mp3_path, title, artist, duration=3)
+        # Bản standard + mọi profile client đã xin trong lúc chờ, từ cùng một nguồn YouTube
+        job.set_state('transcoding', 80)
+        profiles = sorted(job.profiles, key=lambda p: p != DEFAULT_PROFILE)
+        outputs = [(p, os.path.join(CACHE_DIR, f"{rendition_name(cache_filename, p)}.transcode.tmp")) for p in profiles]
+        expected_mp3_size = (job.duration or 0) * AUDIO_PROFILES[DEFAULT_PROFILE]['bitrate'] * 1000 / 8
+        progress = asyncio.create_task(watch_progress(job, [outputs[0][1]], expected_mp3_size, 80, 99))
+        with stage_seconds.time('transcode'):
+            await ffmpeg_pool.run(transcode_args(source_path, outputs), label=cache_filename)
+        progress.cancel()
+        for profile, tmp_path in outputs:
+            await asyncio.to_thread(commit_file, tmp_path, os.path.join(CACHE_DIR, rendition_name(cache_filename, profile)))
+        if source_path != mp3_path and os.path.exists(source_path):
+            os.remove(source_path)
+        cleanup_temp_files(cache_filename)
+        new_size = await register_cached_mp3(cache_filename)
+        cache_lru.record(cache_filename, *(rendition_name(cache_filename, p) for p in profiles[1:]))
+        logger.info(f"Background real MP3 downloaded ({new_size/1024/1024:.2f} MB, profiles {', '.join(profiles)}): {mp3_path}")
+    except Exception as e:
+        logger.error(f"Background download failed: {e}")
+        cleanup_temp_files(cache_filename)
+    except asyncio.CancelledError:
+        logger.info(f"Download of {cache_filename} handed over to live stream")
+        cleanup_temp_files(cache_filename)
+        raise
+    finally:
+        if progress is not None:
+            progress.cancel()
+        for _, tmp_path in outputs:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+class DownloadQueueFullError(RuntimeError):
+    pass
+
+class DownloadJob:
+    def __init__(self, cache_filename, full_query, title, artist, duration, video_id, priority):
+        self.cache_filename = cache_filename
+        self.full_query = full_query
+        self.title = title
+        self.artist = artist
+        self.duration = duration
+        self.video_id = video_id
+        self.priority = priority
+        self.profiles = {DEFAULT_PROFILE}  # rendition encode ngay từ nguồn tải về
+        self.ratelimit = None  # bytes/s cho yt-dlp, None = không giới hạn
+        self.live = None  # LiveStream đang ghi chính rendition mà job sẽ tạo
+        self.task = None  # asyncio.Task chạy background_download (hoặc chờ live stream)
+        self.state = 'queued'  # queued -> downloading -> transcoding -> ready | failed | dropped
+        self.progress = 0
+        self.done = asyncio.get_running_loop().create_future()
+        self.changed = asyncio.Condition()
+
+    def _notify(self):
+        async def notify():
+            async with self.changed:
+                self.changed.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+
+    def set_state(self, state, progress=None):
+        self.state = state
+        if progress is not None:
+            self.progress = progress
+        self._notify()
+
+    def set_progress(self, progress):
+        progress = int(progress)
+        if progress != self.progress:
+            self.progress = progress
+            self._notify()
+
+    def finish(self, state):
+        self.set_state(state, 100 if state == 'ready' else self.progress)
+        if not self.done.done():
+            self.done.set_result(state)
+
+    async def wait_change(self, state, timeout):
+        try:
+            async with self.changed:
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.state != state), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self):
+        return {'state': self.state, 'progress': self.progress, 'priority': self.priority, 'ready': self.state == 'ready'}
+
+class DownloadScheduler:
+    """Priority queue of download jobs, deduplicated by cache hash.
+
+    A key already queued or running is joined (and its priority raised if the
+    new request is more urgent). The queue is bounded: when full, a more
+    urgent job displaces the least urgent queued one, otherwise it is refused.
+    A job whose track is being teed by a live stream is finished when that
+    stream ends, without holding one of the workers.
+    """
+    def __init__(self, jobs, workers, max_queued):
+        self.jobs = jobs  # cache_filename -> DownloadJob (queued or running)
+        self.worker_count = workers
+        self.max_queued = max_queued
+        self.queue = None
+        self.workers = []
+        self.seq = 0
+        self.history = TTLCache(JOB_HISTORY_TTL, 1024)  # cache_filename -> DownloadJob đã xong
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+    def queued(self):
+        return [job for job in self.jobs.values() if job.state == 'queued']
+
+    def _push(self, job):
+        self.seq += 1
+        self.queue.put_nowait((job.priority, self.seq, job))
+
+    def bump(self, cache_filename, priority):
+        job = self.jobs.get(cache_filename)
+        if job is not None and priority < job.priority and job.state == 'queued':
+            logger.info(f"Raising priority of {cache_filename}: {job.priority} -> {priority}")
+            job.priority = priority
+            if priority < PRIORITY_PREFETCH:
+                job.ratelimit = None  # Người dùng đang chờ: bỏ giới hạn băng thông của prefetch
+            self._push(job)  # Bản cũ trong heap bị bỏ qua khi lấy ra
+        return job
+
+    def submit(self, cache_filename, full_query, title, artist, duration, video_id=None, priority=PRIORITY_USER,
+               profile=DEFAULT_PROFILE, ratelimit=None):
+        if not self.workers:
+            self.start()
+        job = self.jobs.get(cache_filename)
+        if job is not None:
+            if job.state in ('queued', 'downloading'):
+                job.profiles.add(profile)
+            return self.bump(cache_filename, priority)
         
-        # Fallback lyrics
-        create_fallback_lyrics(title, artist, lrc_path)
+        queued = self.queued()
+        if len(queued) >= self.max_queued:
+            worst = max(queued, key=lambda j: j.priority)
+            if worst.priority <= priority:
+                raise DownloadQueueFullError(f"Download queue full ({len(queued)} jobs)")
+            logger.info(f"Queue full, dropping {worst.cache_filename} (priority {worst.priority})")
+            self._retire(worst, 'dropped')
         
-        # Extract info NHANH
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'http_headers': YOUTUBE_HEADERS,
-            'noplaylist': True,
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-        }
+        job = DownloadJob(cache_filename, full_query, title, artist, duration, video_id, priority)
+        job.profiles.add(profile)
+        job.ratelimit = ratelimit
+        self.jobs[cache_filename] = job
+        self._push(job)
+        logger.info(f"Queued download {cache_filename} (priority {priority}, {len(self.queued())} queued)")
+        return job
+
+    def hand_over(self, cache_filename, live):
+        """Let a live stream of the standard rendition do a job's work instead of a second pull + transcode."""
+        job = self.jobs.get(cache_filename)
+        if job is None or job.live is not None:
+            return
+        if job.task is not None and not job.task.done():
+            # Worker thấy task bị huỷ cùng job.live thì chuyển job sang live stream
+            logger.info(f"Live stream takes over running download of {cache_filename}")
+            job.live = live
+            job.task.cancel()
+        elif job.state == 'queued':
+            self._follow_live(job, live)  # Entry trong heap bị bỏ qua vì state đã đổi
+
+    def _follow_live(self, job, live):
+        job.live = live
+        job.set_state('downloading')
+        job.task = asyncio.create_task(self._finish_from_live(job, live))
+
+    async def _finish_from_live(self, job, live):
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(f"ytsearch1:{full_query}", download=False)
-                title = info.get('title', title)
-                artist = parse_artist_from_title(title, query_artist) or info.get('uploader', artist)
-                duration = info.get('duration', duration)
-                if 'thumbnail' in info:
-                    cover_url = info['thumbnail'].replace('default.jpg', 'maxresdefault.jpg')
+            await live.wait_done()
+            if live.ok:
+                await finish_download(job)
+            state = 'ready' if live.ok else 'failed'
         except Exception as e:
-            logger.warning(f"Fast extract fail: {e}")
-        
-        # Background real download
-        asyncio.create_task(background_download(full_query, cache_filename, title, artist, duration))
+            logger.error(f"Finishing {job.cache_filename} from live stream failed: {e}", exc_info=True)
+            state = 'failed'
+        self._retire(job, state)
+
+    def _retire(self, job, state):
+        forget_inflight(self.jobs, job.cache_filename, job)
+        self.history.set(job.cache_filename, job)
+        job.finish(state)
+
+    async def worker(self):
+        while True:
+            priority, _, job = await self.queue.get()
+            # Bỏ qua entry cũ (đã nâng ưu tiên / đã bị drop)
+            if job.state != 'queued' or priority != job.priority:
+                continue
+            live = live_streams.get(rendition_name(job.cache_filename))
+            if live is not None:
+                logger.info(f"Live stream in progress for {job.cache_filename}, finishing job when it ends")
+                self._follow_live(job, live)
+                continue
+            try:
+                job.task = asyncio.create_task(background_download(job))
+                await asyncio.wait([job.task])
+                if job.task.cancelled() and job.live is not None:
+                    # Live stream nhận việc giữa chừng (hand_over): worker rảnh, job xong khi live xong
+                    self._follow_live(job, job.live)
+                    continue
+                if job.task.cancelled():
+                    raise RuntimeError('download task cancelled')
+                job.task.result()
+                mp3_path = os.path.join(CACHE_DIR, f"{job.cache_filename}.mp3")
+                state = 'ready' if os.path.exists(mp3_path) else 'failed'
+            except Exception as e:
+                logger.error(f"Download job {job.cache_filename} crashed: {e}", exc_info=True)
+                state = 'failed'
+            self._retire(job, state)
+
+    def status(self, cache_filename):
+        return self.jobs.get(cache_filename) or self.history.get(cache_filename)
+
+download_scheduler = DownloadScheduler(inflight_downloads, DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_MAX)
+
+class LiveStream:
+    """One FFmpeg transcode fanned out to every client and teed into the cache.
+
+    Only the last LIVE_WINDOW_BYTES stay in memory; clients joining late or
+    falling behind replay the earlier part from the tee file. FFmpeg is read as
+    fast as it encodes, so the transcode releases its ffmpeg_pool slot early;
+    each client is paced only by its own writes. On success the teed temp file
+    is renamed onto `output_name` in CACHE_DIR.
+    """
+    def __init__(self, cache_filename, output_name, input_args, output_args):
+        self.cache_filename = cache_filename
+        self.output_name = output_name
+        self.input_args = input_args
+        self.output_args = output_args
+        self.output_path = os.path.join(CACHE_DIR, output_name)
+        self.tmp_path = f"{self.output_path}.{os.getpid()}.live.tmp"
+        self.chunks = deque()
+        self.offset = 0      # Vị trí byte của chunk đầu tiên còn trong cửa sổ
+        self.size = 0        # Tổng byte đã ghi ra file tee
+        self.done = False
+        self.ok = False
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.produce())
+        return self
+
+    async def wait_done(self):
+        await asyncio.shield(self.task)
+
+    async def _publish(self, chunk=None):
+        async with self.changed:
+            if chunk:
+                self.chunks.append(chunk)
+                self.size += len(chunk)
+                while len(self.chunks) > 1 and self.size - self.offset > LIVE_WINDOW_BYTES:
+                    self.offset += len(self.chunks.popleft())
+            self.changed.notify_all()
+
+    async def produce(self):
+        args = ['-loglevel', 'error', *self.input_args, *self.output_args, 'pipe:1']
+        returncode = None
+        try:
+            async with ffmpeg_pool.spawn(args, f"live {self.output_name}",
+                                         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL) as proc:
+                async with aiofiles.open(self.tmp_path, 'wb') as f:
+                    while True:
+                        chunk = await asyncio.wait_for(proc.stdout.read(LIVE_CHUNK_SIZE), LIVE_READ_TIMEOUT)
+                        if not chunk:
+                            break
+                        await f.write(chunk)
+                        await f.flush()  # Client tụt khỏi cửa sổ đọc lại phần này từ file
+                        await self._publish(chunk)
+                returncode = await asyncio.wait_for(proc.wait(), LIVE_READ_TIMEOUT)
+            if returncode == 0 and self.size > 100000:
+                await asyncio.to_thread(commit_file, self.tmp_path, self.output_path)
+                if self.output_name == rendition_name(self.cache_filename):
+                    await register_cached_mp3(self.cache_filename)
+                else:
+                    cache_lru.record(self.cache_filename, self.output_name)
+                self.ok = True
+                logger.info(f"Live stream finished, cached {self.size / 1024 / 1024:.2f} MB: {self.output_path}")
+            else:
+                logger.error(f"Live stream failed for {self.output_name} (rc={returncode}, {self.size} bytes)")
+        except Exception as e:
+            logger.error(f"Live stream error for {self.output_name}: {e}")
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            self.done = True
+            await self._publish()
+
+    async def _open_replay(self):
+        # File tee, hoặc file cache nếu transcode vừa xong và đã rename
+        for path in (self.tmp_path, self.output_path):
+            try:
+                return await aiofiles.open(path, 'rb')
+            except FileNotFoundError:
+                continue
+        return None
+
+    async def follow(self, response):
+        route = 'live' if self.output_name.endswith('.mp3') else 'stream_pcm'
+        sent = 0
+        replay = None
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: sent < self.size or self.done)
+                    start = self.offset
+                    pending = list(self.chunks)
+                if sent >= start + sum(len(c) for c in pending):
+                    break
+                if sent < start:
+                    # Ngoài cửa sổ RAM: đọc lại từ file, giữ fd mở qua lúc rename
+                    if replay is None:
+                        replay = await self._open_replay()
+                        if replay is None:
+                            break
+                    await replay.seek(sent)
+                    data = await replay.read(min(start - sent, LIVE_WINDOW_BYTES))
+                    if not data:
+                        break
+                    await response.write(data)
+                    bytes_served.inc(route, amount=len(data))
+                    sent += len(data)
+                    continue
+                position = start
+                for chunk in pending:
+                    if position >= sent:
+                        await response.write(chunk)
+                        bytes_served.inc(route, amount=len(chunk))
+                        sent += len(chunk)
+                    position += len(chunk)
+        finally:
+            if replay is not None:
+                await replay.close()
+
+def youtube_watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+EXTRACT_OPTS = {
+    'format': 'bestaudio/best',
+    'http_headers': YOUTUBE_HEADERS,
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+}
+
+async def resolve_video(full_query, alias):
+    """Return the extracted info for a query, searching YouTube at most once per TTL."""
+    video_id = video_id_cache.get(alias) or cache_index.get_alias(alias)
+    if video_id is not None:
+        info = info_cache.get(video_id)
+        if info is not None:
+            logger.info(f"Resolve cache hit: {full_query} -> {video_id}")
+            cache_lookups.inc('resolve', 'hit')
+            return info
+        query = youtube_watch_url(video_id)
+    else:
+        query = f"ytsearch1:{full_query}"
+    cache_lookups.inc('resolve', 'miss')
+    with stage_seconds.time('extract'):
+        info = await extract_pool.run(ydl_extract_info, query, EXTRACT_OPTS)
+    video_id_cache.set(alias, info['id'])
+    info_cache.set(info['id'], info)
+    return info
+
+async def resolve_stream_source(video_id):
+    info = info_cache.get(video_id)
+    if info is None:
+        with stage_seconds.time('extract'):
+            info = await extract_pool.run(ydl_extract_info, youtube_watch_url(video_id), EXTRACT_OPTS)
+        info_cache.set(video_id, info)
+    return info['url'], info.get('http_headers', YOUTUBE_HEADERS)
+
+def start_live_stream(registry, key, live):
+    live.start()
+    registry[key] = live
+    live.task.add_done_callback(lambda _: forget_inflight(registry, key, live))
+    logger.info(f"Started live stream {live.output_name}")
+    return live
+
+async def get_live_stream(cache_filename, profile=DEFAULT_PROFILE):
+    name = rendition_name(cache_filename, profile)
+    live = live_streams.get(name)
+    if live is not None:
+        logger.info(f"Joining live stream for {name}")
+        return live
+    source = best_cached_rendition(cache_filename, profile)
+    if source is not None:
+        # Đã có bản tốt hơn (hoặc bằng) trong cache: transcode cục bộ, không tải lại từ YouTube
+        input_args = ['-i', os.path.join(CACHE_DIR, rendition_name(cache_filename, source))]
+    else:
+        row = cache_index.get(cache_filename)
+        if row is None or not row['video_id']:
+            return None
+        input_args = url_input_args(*await resolve_stream_source(row['video_id']))
+    # Có thể request khác đã tạo stream trong lúc resolve
+    live = live_streams.get(name)
+    if live is None:
+        live = start_live_stream(live_streams, name, LiveStream(
+            cache_filename, name, input_args, profile_encode_args(profile)))
+        if profile == DEFAULT_PROFILE:
+            # Live tee ra đúng <track>.mp3: job tải (chờ hoặc đang chạy) nhường cho live
+            download_scheduler.hand_over(cache_filename, live)
+    return live
+
+async def send_live_stream(request, live, headers):
+    response = web.StreamResponse(headers={**headers, 'Cache-Control': 'no-store'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    try:
+        # response.write chờ drain: client chậm tự tạo back-pressure
+        await live.follow(response)
+    except ConnectionResetError:
+        logger.info(f"Live client disconnected from {live.output_name}")
+        return response
+    await response.write_eof()
+    return response
+
+def header_int(request, name, default):
+    try:
+        return int(request.headers.get(name, default))
+    except ValueError:
+        return default
+
+def negotiate_pcm_format(request):
+    """Read the requested raw format from X-Audio-* headers; None keeps the JSON/MP3 mode."""
+    codec = (request.headers.get('X-Audio-Format') or request.query.get('format', '')).lower()
+    if codec not in ('pcm', 'adpcm'):
+        return None
+    requested_rate = header_int(request, 'X-Sample-Rate', PCM_DEFAULT_SAMPLE_RATE)
+    rate = min(PCM_SAMPLE_RATES, key=lambda r: abs(r - requested_rate))
+    if codec == 'adpcm':
+        bits = 4
+    else:
+        bits = 8 if header_int(request, 'X-Bits-Per-Sample', 16) == 8 else 16
+    channels = 2 if header_int(request, 'X-Channels', 1) == 2 else 1
+    return {'codec': codec, 'rate': rate, 'bits': bits, 'channels': channels}
+
+def pcm_output_name(cache_filename, fmt):
+    if fmt['codec'] == 'adpcm':
+        return f"{cache_filename}.ima_{fmt['rate']}_{fmt['channels']}.wav"
+    sample = 's16' if fmt['bits'] == 16 else 'u8'
+    return f"{cache_filename}.{sample}_{fmt['rate']}_{fmt['channels']}.pcm"
+
+def pcm_output_args(fmt):
+    args = ['-vn', '-ar', str(fmt['rate']), '-ac', str(fmt['channels'])]
+    if fmt['codec'] == 'adpcm':
+        return args + ['-c:a', 'adpcm_ima_wav', '-f', 'wav']
+    if fmt['bits'] == 8:
+        return args + ['-c:a', 'pcm_u8', '-f', 'u8']
+    return args + ['-c:a', 'pcm_s16le', '-f', 's16le']
+
+def pcm_headers(fmt):
+    return {
+        'Content-Type': 'audio/wav' if fmt['codec'] == 'adpcm' else 'application/octet-stream',
+        'X-Audio-Format': fmt['codec'],
+        'X-Sample-Rate': str(fmt['rate']),
+        'X-Bits-Per-Sample': str(fmt['bits']),
+        'X-Channels': str(fmt['channels']),
+    }
+
+async def stream_pcm_audio(request, cache_filename, fmt):
+    name = pcm_output_name(cache_filename, fmt)
+    path = os.path.join(CACHE_DIR, name)
+    headers = pcm_headers(fmt)
     
-    logger.info(f"Metadata ready: {title} by {artist}, duration {duration}s, FFmpeg fallback ready")
+    # Đã decode trước đó: gửi thẳng file (sendfile + Range)
+    if name not in pcm_streams and os.path.exists(path):
+        cache_lru.touch(cache_filename)
+        return web.FileResponse(path, headers=headers)
     
-    return {
+    live = pcm_streams.get(name)
+    if live is None:
+        source = best_cached_rendition(cache_filename)
+        if source is not None:
+            input_args = ['-i', os.path.join(CACHE_DIR, rendition_name(cache_filename, source))]
+        else:
+            row = cache_index.get(cache_filename)
+            if row is None or not row['video_id']:
+                return web.json_response({'error': 'Track not ready'}, status=503)
+            input_args = url_input_args(*await resolve_stream_source(row['video_id']))
+        live = pcm_streams.get(name)
+        if live is None:
+            live = start_live_stream(pcm_streams, name, LiveStream(cache_filename, name, input_args, pcm_output_args(fmt)))
+    return await send_live_stream(request, live, headers)
+
+def build_metadata(cache_filename, title, artist, duration, from_cache):
+    metadata = {
+        'track_id': cache_filename,
         'artist': artist,
         'title': title,
-        'audio_url': f"/music_cache/{cache_filename}.mp3",
-        'cover_url': cover_url,
+        'audio_url': f"/music_cache/{rendition_name(cache_filename)}",
+        'cover_url': f"/cover/{cache_filename}",  # ảnh đã resize, phục vụ từ LAN
         'duration': duration,
         'from_cache': from_cache,
         'lyric_url': f"/music_cache/{cache_filename}.lrc"
     }
+    if not from_cache:
+        # Client có thể phát ngay qua live_url thay vì chờ tiếng beep
+        metadata['live_url'] = f"/live/{rendition_name(cache_filename)}"
+    return metadata
+
+def with_profile(metadata, profile):
+    """Point metadata URLs at the rendition of `profile`, adding it to a pending download.
+
+    A cached track missing the rendition gets it encoded now: the
+    unauthenticated /music_cache route only serves files that exist.
+    """
+    metadata['profile'] = profile
+    if profile == DEFAULT_PROFILE:
+        return metadata
+    track_id = metadata['track_id']
+    name = rendition_name(track_id, profile)
+    job = inflight_downloads.get(track_id)
+    if job is not None and job.state in ('queued', 'downloading'):
+        job.profiles.add(profile)
+    metadata['audio_url'] = f"/music_cache/{name}"
+    metadata['from_cache'] = has_rendition(track_id, profile)
+    if metadata['from_cache']:
+        metadata.pop('live_url', None)
+    else:
+        metadata['live_url'] = f"/live/{name}"
+        if (job is None or profile not in job.profiles) and has_cached_mp3(track_id):
+            start_rendition_encode(track_id, profile)
+    return metadata
+
+def start_rendition_encode(track_id, profile):
+    name = rendition_name(track_id, profile)
+    if name in live_streams or name in rendition_encodes:
+        return
+    task = asyncio.create_task(get_live_stream(track_id, profile))
+    rendition_encodes[name] = task
+    task.add_done_callback(functools.partial(forget_rendition_encode, name))
+
+def forget_rendition_encode(name, task):
+    forget_inflight(rendition_encodes, name, task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Cannot start encode of {name}: {task.exception()}")
+
+def forget_inflight(registry, key, task):
+    if registry.get(key) is task:
+        registry.pop(key)
+
+def release_inflight_metadata(alias, task):
+    # Giữ metadata của leader cho tới khi download xong, để request đến sau
+    # (trong lúc đang tải) không search lại
+    if task.cancelled() or task.exception() is not None:
+        forget_inflight(inflight_metadata, alias, task)
+        return
+    download = inflight_downloads.get(task.result()['track_id'])
+    if download is None:
+        forget_inflight(inflight_metadata, alias, task)
+    else:
+        download.done.add_done_callback(lambda _: forget_inflight(inflight_metadata, alias, task))
+
+def cached_track_metadata(track_id, full_query, query_artist=''):
+    if not has_cached_mp3(track_id):
+        return None
+    logger.info(f"Cache hit: {track_id}.mp3")
+    cache_lru.touch(track_id)
+    row = cache_index.get(track_id)
+    if row is None:
+        # File cũ chưa có trong index
+        return build_metadata(track_id, full_query, query_artist or 'Unknown', 180, True)
+    return build_metadata(track_id, row['title'] or full_query, row['artist'] or query_artist or 'Unknown',
+                          row['duration'] or 180, True)
+
+async def resolve_cache_miss(full_query, alias, query_artist='', priority=PRIORITY_USER, ratelimit=None):
+    title = full_query
+    artist = query_artist or 'Unknown'
+    duration = 180
+    cover_url = DEFAULT_COVER_URL
+    video_id = None
+    
+    logger.info(f"Cache miss, resolving {full_query}")
+    
+    # Extract info NHANH (thread pool); fallback audio phục vụ từ RAM bởi serve_cached_mp3
+    try:
+        info = await resolve_video(full_query, alias)
+    except Exception as e:
+        logger.warning(f"Fast extract fail: {e}")
+    else:
+        video_id = info.get('id')
+        cache_index.put_alias(alias, video_id)
+        # Cách gọi khác của cùng một bài đã được tải: dùng luôn file đó
+        metadata = cached_track_metadata(video_id, full_query, query_artist)
+        if metadata is not None:
+            return metadata
+        title = info.get('title', title)
+        artist = parse_artist_from_title(title, query_artist) or info.get('uploader', artist)
+        duration = info.get('duration', duration)
+        if 'thumbnail' in info:
+            cover_url = info['thumbnail'].replace('default.jpg', 'maxresdefault.jpg')
+        cache_index.put(video_id, title=title, artist=artist, duration=duration,
+                        thumbnail=cover_url, video_id=video_id)
+    
+    # Lưu file theo video id; không resolve được thì theo hash của alias
+    track_id = video_id or alias
+    
+    # Fallback lyrics
+    lrc_path = os.path.join(CACHE_DIR, f"{track_id}.lrc")
+    if not os.path.exists(lrc_path):
+        create_fallback_lyrics(title, artist, lrc_path)
+        cache_lru.record(track_id)
+    
+    # Background real download (mặc định ưu tiên cao: người dùng đang chờ)
+    try:
+        download_scheduler.submit(track_id, full_query, title, artist, duration, video_id, priority, ratelimit=ratelimit)
+    except DownloadQueueFullError as e:
+        logger.warning(f"Cannot queue download for {full_query}: {e}")
+    
+    logger.info(f"Metadata ready: {title} by {artist}, duration {duration}s, in-memory fallback ready")
+    return build_metadata(track_id, title, artist, duration, False)
+
+async def get_music_metadata(full_query, alias, query_artist='', priority=PRIORITY_USER, ratelimit=None):
+    # Alias đã biết video id, file tải khi extract lỗi (đặt theo alias), hoặc file cũ theo hash của query
+    for track_id in (cache_index.get_alias(alias), alias, generate_hash(full_query)):
+        if track_id:
+            metadata = cached_track_metadata(track_id, full_query, query_artist)
+            if metadata is not None:
+                cache_lookups.inc('track', 'hit')
+                return metadata
+    cache_lookups.inc('track', 'miss')
+    
+    # Single-flight: request đầu tiên (leader) làm việc, các request trùng chờ kết quả
+    task = inflight_metadata.get(alias)
+    if task is None:
+        task = asyncio.create_task(resolve_cache_miss(full_query, alias, query_artist, priority, ratelimit))
+        inflight_metadata[alias] = task
+        task.add_done_callback(functools.partial(release_inflight_metadata, alias))
+    else:
+        logger.info(f"Joining in-flight request for {alias}")
+    
+    # shield: một client huỷ request không huỷ công việc chung
+    metadata = dict(await asyncio.shield(task))
+    # Leader có thể là prefetch ưu tiên thấp: người dùng chờ thì đẩy job lên
+    download_scheduler.bump(metadata['track_id'], priority)
+    return metadata
 
 async def stream_pcm(request):
     try:
@@ -350,13 +1796,20 @@ async def stream_pcm(request):
         
         logger.info(f"Music request: song='{song}', artist='{artist}', query='{full_query}'")
         
-        normalized_query = full_query.lower().strip()
-        cache_filename = generate_hash(normalized_query)
-        logger.info(f"Normalized for hash: '{normalized_query}', Cache filename: {cache_filename}")
+        canonical = canonical_query(full_query)
+        alias = generate_hash(canonical)
+        logger.info(f"Canonical query: '{canonical}', alias: {alias}")
+        
+        with stage_seconds.time('metadata'):
+            metadata = await get_music_metadata(full_query, alias, artist)
         
-        metadata = await get_music_metadata(full_query, cache_filename, artist)
+        # Chế độ raw PCM/ADPCM (header X-Audio-Format): stream audio thay vì JSON
+        pcm_format = negotiate_pcm_format(request)
+        if pcm_format is not None:
+            return await stream_pcm_audio(request, metadata['track_id'], pcm_format)
         
-        logger.info(f"Metadata returned for {metadata['title']} ({metadata['duration']}s)")
+        metadata = with_profile(metadata, negotiate_profile(request))
+        logger.info(f"Metadata returned for {metadata['title']} ({metadata['duration']}s, {metadata['profile']})")
         return web.json_response({
             'success': True,
             **metadata
@@ -365,32 +1818,737 @@ async def stream_pcm(request):
     except Exception as e:
         logger.error(f"Error in stream_pcm: {str(e)}", exc_info=True)
         return web.json_response({'error': f'Server error: {str(e)}'}, status=500)
-    finally:
-        gc.collect()
-        log_memory("After stream_pcm")
 
-# /search (omit)
+async def live_stream(request):
+    name = request.match_info['name']
+    cache_filename, profile = split_rendition(name)
+    
+    if name not in live_streams and has_rendition(cache_filename, profile):
+        return await serve_cached_mp3(request, cache_filename, profile)
+    return await stream_rendition(request, cache_filename, profile)
+
+async def stream_rendition(request, cache_filename, profile=DEFAULT_PROFILE):
+    try:
+        live = await get_live_stream(cache_filename, profile)
+    except Exception as e:
+        logger.error(f"Cannot start live stream for {cache_filename} ({profile}): {e}")
+        return web.json_response({'error': 'Stream unavailable'}, status=502)
+    if live is None:
+        return web.json_response({'error': 'Unknown track'}, status=404)
+    if live.done and live.ok:
+        return await serve_cached_mp3(request, cache_filename, profile)
+    
+    return await send_live_stream(request, live, {'Content-Type': 'audio/mpeg'})
+
+# Serve /music_cache: FileResponse (sendfile + Range), ETag theo cache hash, hot tier trong RAM
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+HOT_TIER_MAX_BYTES = 8 * 1024 * 1024
+HOT_MP3_HEAD_BYTES = 64 * 1024   # Phần đầu MP3 (ID3 + frame đầu) của bài hay phát
+HOT_MP3_MIN_PLAYS = 3
+
+class HotTier:
+    """Byte-bounded LRU of small cache blobs: whole .lrc files and MP3 heads."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()  # file name -> bytes
+        self.total_bytes = 0
+        self.play_counts = {}       # cache_filename -> số lần phát từ đầu
+
+    def get(self, name):
+        data = self.items.get(name)
+        if data is not None:
+            self.items.move_to_end(name)
+        return data
+
+    def put(self, name, data):
+        if len(data) > self.max_bytes:
+            return
+        self.discard(name)
+        self.items[name] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes:
+            _, old = self.items.popitem(last=False)
+            self.total_bytes -= len(old)
+
+    def discard(self, name):
+        data = self.items.pop(name, None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+    def discard_track(self, cache_filename):
+        for name in [name for name in self.items if name.startswith(f"{cache_filename}.")]:
+            self.discard(name)
+        self.play_counts.pop(cache_filename, None)
+
+    def count_play(self, cache_filename):
+        self.play_counts[cache_filename] = self.play_counts.get(cache_filename, 0) + 1
+        return self.play_counts[cache_filename]
+
+hot_tier = HotTier(HOT_TIER_MAX_BYTES)
+
+def etag_matches(request, etag):
+    return any(e.value in (etag, '*') for e in request.if_none_match or ())
+
+async def apply_cache_headers(request, response):
+    # FileResponse tự đặt ETag theo mtime; ghi đè bằng ETag theo cache hash ngay trước khi gửi header
+    headers = request.get('cache_headers')
+    if headers and response.status in (200, 206):
+        response.headers.update(headers)
+
+async def count_bytes_served(request, response):
+    # Body có độ dài cố định (FileResponse đã tính theo Range); stream chunked đếm trong LiveStream.follow
+    if response.content_length and request.match_info.route.resource is not None:
+        bytes_served.inc(request.path.split('/')[1], amount=response.content_length)
+
+async def read_file_head(path, size):
+    async with aiofiles.open(path, 'rb') as f:
+        return await f.read(size)
+
+async def serve_cache_file(request):
+    name = request.match_info['name']
+    if name.endswith('.lrc'):
+        cache_filename, profile = name[:-len('.lrc')], None
+    else:
+        cache_filename, profile = split_rendition(name)
+    cache_lru.touch(cache_filename)
+    # Stage 'static' đo trong StageAccessLogger: FileResponse chỉ gửi file sau khi handler return
+    if profile is None:
+        return await serve_cached_lrc(request, cache_filename, name)
+    return await serve_cached_mp3(request, cache_filename, profile)
+
+async def serve_cached_lrc(request, cache_filename, name):
+    body = hot_tier.get(name)
+    if body is None:
+        try:
+            async with aiofiles.open(os.path.join(CACHE_DIR, name), 'rb') as f:
+                body = await f.read()
+        except FileNotFoundError:
+            raise web.HTTPNotFound()
+        hot_tier.put(name, body)
+    etag = f"{cache_filename}-lrc-{len(body):x}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='text/plain', charset='utf-8', headers=headers)
+
+async def serve_cached_mp3(request, cache_filename, profile=DEFAULT_PROFILE):
+    name = rendition_name(cache_filename, profile)
+    mp3_path = os.path.join(CACHE_DIR, name)
+    row = cache_index.get(cache_filename) if profile == DEFAULT_PROFILE else None
+    size = row['file_size'] if row else 0
+    if not size:
+        try:
+            size = os.stat(mp3_path).st_size
+        except FileNotFoundError:
+            if profile != DEFAULT_PROFILE:
+                # Route không auth: không tự khởi động FFmpeg, /stream_pcm (có auth) đã bắt đầu encode
+                raise web.HTTPNotFound()
+            return serve_fallback_mp3(cache_filename)
+    
+    # 304 không cần chạm tới disk
+    etag = f"{name[:-len('.mp3')]}-{size:x}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    
+    try:
+        rng = request.http_range
+    except ValueError:
+        rng = slice(None, None)  # FileResponse sẽ trả 416
+    head = hot_tier.get(name)
+    if head is not None and rng.start is not None and rng.stop is not None and 0 <= rng.start < rng.stop <= len(head):
+        return web.Response(status=206, body=head[rng.start:rng.stop], content_type='audio/mpeg', headers={
+            **headers,
+            'Accept-Ranges': 'bytes',
+            'Content-Range': f"bytes {rng.start}-{rng.stop - 1}/{size}",
+        })
+    
+    if not rng.start and head is None and hot_tier.count_play(cache_filename) >= HOT_MP3_MIN_PLAYS:
+        hot_tier.put(name, await read_file_head(mp3_path, HOT_MP3_HEAD_BYTES))
+    
+    request['cache_headers'] = headers
+    return web.FileResponse(mp3_path, headers={'Content-Type': 'audio/mpeg'})
+
+def serve_fallback_mp3(cache_filename):
+    # Chưa có mp3: trả fallback beep từ RAM, không ghi file. Cả khi job lỗi / bị drop / queue đầy:
+    # metadata đã đưa audio_url cho thiết bị, URL đó luôn phải phát được
+    # (track theo alias khi extract lỗi không có row: lịch sử job vẫn biết nó)
+    known = (cache_index.get(cache_filename) is not None or download_scheduler.status(cache_filename) is not None
+             or track_pending(cache_filename))
+    if not known or not fallback_audio:
+        raise web.HTTPNotFound()
+    row = cache_index.get(cache_filename) or {}
+    body = fallback_mp3(row.get('title') or cache_filename, row.get('artist') or 'Unknown')
+    return web.Response(body=body, content_type='audio/mpeg', headers={'Cache-Control': 'no-store'})
+
+# /cover: tải artwork một lần, resize + encode theo màn hình thiết bị, lưu cạnh track trong CACHE_DIR
+COVER_DEFAULT_SIZE = 240
+COVER_MAX_SIZE = 480
+COVER_JPEG_QUALITY = 80
+COVER_FETCH_TIMEOUT = 10
+COVER_FORMATS = {  # format -> (đuôi file, Content-Type)
+    'jpeg': ('jpg', 'image/jpeg'),
+    'png': ('png', 'image/png'),
+    'rgb565': ('rgb565', 'application/octet-stream'),  # raw 16-bit little-endian cho TFT
+}
+COVER_DEFAULT_RENDITIONS = 8  # Số kích thước cover mặc định giữ trong RAM
+http_session = None
+inflight_covers = {}  # tên file cover -> asyncio.Task
+default_cover_source = None  # Ảnh gốc DEFAULT_COVER_URL, tải một lần
+default_covers = OrderedDict()  # (width, height, format) -> bytes, không ghi file theo từng track
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=COVER_FETCH_TIMEOUT),
+                                             headers={'User-Agent': YOUTUBE_HEADERS['User-Agent']})
+    return http_session
+
+def cover_request_params(request):
+    def dimension(param, header):
+        try:
+            value = int(request.query.get(param) or request.headers.get(header) or COVER_DEFAULT_SIZE)
+        except ValueError:
+            value = COVER_DEFAULT_SIZE
+        return max(16, min(value, COVER_MAX_SIZE))
+    fmt = (request.query.get('format') or request.headers.get('X-Image-Format') or 'jpeg').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in COVER_FORMATS or Image is None:
+        fmt = 'jpeg'
+    return dimension('w', 'X-Display-Width'), dimension('h', 'X-Display-Height'), fmt
+
+def cover_track_known(cache_filename):
+    # Chỉ track server đã resolve/cache mới có cover (id lạ không được kích hoạt fetch hay ghi file)
+    if cache_index.get(cache_filename) is not None or has_cached_mp3(cache_filename):
+        return True
+    return shared_cache and cache_index.refresh(cache_filename) is not None
+
+def cover_source_urls(cache_filename):
+    # Chỉ ảnh riêng của track; ảnh mặc định phục vụ từ RAM, không lưu theo id
+    row = cache_index.get(cache_filename) or {}
+    urls = []
+    if row.get('thumbnail') and row['thumbnail'] != DEFAULT_COVER_URL:
+        urls.append(row['thumbnail'])
+    if row.get('video_id'):
+        # maxresdefault không phải video nào cũng có
+        urls.append(f"https://i.ytimg.com/vi/{row['video_id']}/hqdefault.jpg")
+    return urls
+
+async def fetch_image(url, label):
+    try:
+        async with get_http_session().get(url) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Cover fetch failed for {label} ({url}): {e}")
+        return None
+
+async def fetch_cover_source(cache_filename):
+    path = os.path.join(CACHE_DIR, f"{cache_filename}.cover.jpg")
+    try:
+        async with aiofiles.open(path, 'rb') as f:
+            return await f.read()
+    except FileNotFoundError:
+        pass
+    for url in cover_source_urls(cache_filename):
+        data = await fetch_image(url, cache_filename)
+        if data is None:
+            continue
+        async with aiofiles.open(f"{path}.tmp", 'wb') as f:
+            await f.write(data)
+        os.replace(f"{path}.tmp", path)
+        cache_lru.record(cache_filename, os.path.basename(path))
+        logger.info(f"Cached cover source for {cache_filename}: {url} ({len(data)} bytes)")
+        return data
+    return None
+
+def rgb565_bytes(img):
+    data = img.tobytes()
+    out = bytearray(len(data) // 3 * 2)
+    for i in range(len(data) // 3):
+        r, g, b = data[3 * i], data[3 * i + 1], data[3 * i + 2]
+        value = (r >> 3) << 11 | (g >> 2) << 5 | b >> 3
+        out[2 * i] = value & 0xFF
+        out[2 * i + 1] = value >> 8
+    return bytes(out)
+
+def render_cover(source, width, height, fmt):
+    """Crop-to-fill resize and re-encode for the device display (blocking)."""
+    img = ImageOps.fit(Image.open(io.BytesIO(source)).convert('RGB'), (width, height), Image.LANCZOS)
+    if fmt == 'rgb565':
+        return rgb565_bytes(img)
+    out = io.BytesIO()
+    if fmt == 'png':
+        img.save(out, 'PNG', optimize=True)
+    else:
+        # Baseline JPEG: decoder trên ESP32 (TJpgDec) không đọc được progressive
+        img.save(out, 'JPEG', quality=COVER_JPEG_QUALITY, optimize=True, progressive=False)
+    return out.getvalue()
+
+async def build_cover(cache_filename, name, width, height, fmt):
+    source = await fetch_cover_source(cache_filename)
+    if source is None:
+        return False
+    data = source if Image is None else await asyncio.to_thread(render_cover, source, width, height, fmt)
+    path = os.path.join(CACHE_DIR, name)
+    async with aiofiles.open(f"{path}.tmp", 'wb') as f:
+        await f.write(data)
+    os.replace(f"{path}.tmp", path)
+    cache_lru.record(cache_filename, name)
+    return True
+
+async def build_default_cover(width, height, fmt):
+    global default_cover_source
+    if default_cover_source is None:
+        default_cover_source = await fetch_image(DEFAULT_COVER_URL, 'default cover')
+        if default_cover_source is None:
+            return None
+    data = default_cover_source if Image is None else await asyncio.to_thread(
+        render_cover, default_cover_source, width, height, fmt)
+    default_covers[(width, height, fmt)] = data
+    while len(default_covers) > COVER_DEFAULT_RENDITIONS:
+        default_covers.popitem(last=False)
+    return data
+
+async def default_cover(request, width, height, fmt, content_type):
+    key = (width, height, fmt)
+    data = default_covers.get(key)
+    if data is None:
+        name = f"default:{width}x{height}.{fmt}"
+        task = inflight_covers.get(name)
+        if task is None:
+            task = asyncio.create_task(build_default_cover(width, height, fmt))
+            inflight_covers[name] = task
+            task.add_done_callback(functools.partial(forget_inflight, inflight_covers, name))
+        try:
+            data = await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"Cannot build default cover {name}: {e}")
+            data = None
+        if data is None:
+            raise web.HTTPNotFound()
+    else:
+        default_covers.move_to_end(key)
+    etag = f"default-{width}x{height}.{fmt}-{len(data):x}"
+    # Track có thể có ảnh riêng sau này: không cho cache vĩnh viễn
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=3600'}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    headers['Content-Type'] = content_type
+    if Image is not None:
+        headers.update({'X-Image-Width': str(width), 'X-Image-Height': str(height)})
+    return web.Response(body=data, headers=headers)
+
+async def cover(request):
+    cache_filename = request.match_info['cache_filename']
+    if not cover_track_known(cache_filename):
+        raise web.HTTPNotFound()
+    width, height, fmt = cover_request_params(request)
+    ext, content_type = COVER_FORMATS[fmt]
+    name = f"{cache_filename}.cover_{width}x{height}.{ext}" if Image is not None else f"{cache_filename}.cover.jpg"
+    path = os.path.join(CACHE_DIR, name)
+    
+    if not os.path.exists(path):
+        task = inflight_covers.get(name)
+        if task is None:
+            task = asyncio.create_task(build_cover(cache_filename, name, width, height, fmt))
+            inflight_covers[name] = task
+            task.add_done_callback(functools.partial(forget_inflight, inflight_covers, name))
+        try:
+            ok = await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"Cannot build cover {name}: {e}")
+            ok = False
+        if not ok:
+            return await default_cover(request, width, height, fmt, content_type)
+    
+    cache_lru.touch(cache_filename)
+    size = os.path.getsize(path)
+    etag = f"{name}-{size:x}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    request['cache_headers'] = headers
+    headers = {'Content-Type': content_type}
+    if Image is not None:
+        headers.update({'X-Image-Width': str(width), 'X-Image-Height': str(height)})
+    return web.FileResponse(path, headers=headers)
+
+async def download_status(request):
+    cache_filename = request.match_info['cache_filename']
+    audio_url = f"/music_cache/{cache_filename}.mp3"
+    
+    # Long-poll: ?wait=<giây>&state=<trạng thái client đang biết>, trả về ngay khi trạng thái đổi
+    try:
+        wait = min(float(request.query.get('wait', 0)), 60)
+    except ValueError:
+        wait = 0
+    job = inflight_downloads.get(cache_filename)
+    if job is not None and wait > 0:
+        await job.wait_change(request.query.get('state', job.state), wait)
+    
+    if cache_filename in inflight_downloads:
+        return web.json_response({'success': True, 'audio_url': audio_url, **job.to_dict()})
+    if os.path.exists(os.path.join(CACHE_DIR, f"{cache_filename}.mp3")):
+        return web.json_response({'success': True, 'audio_url': audio_url, 'state': 'ready', 'progress': 100, 'ready': True})
+    job = download_scheduler.status(cache_filename)
+    if job is not None:
+        return web.json_response({'success': True, 'audio_url': audio_url, **job.to_dict()})
+    # Job thuộc process khác: chỉ biết trạng thái thô từ khoá track và index chung
+    if track_pending(cache_filename):
+        state = 'downloading' if track_locked(cache_filename) else 'queued'
+        return web.json_response({'success': True, 'audio_url': audio_url, 'state': state, 'progress': 0, 'ready': False})
+    return web.json_response({'error': 'Unknown track', 'state': 'unknown'}, status=404)
+
+SEARCH_OPTS = {
+    'http_headers': YOUTUBE_HEADERS,
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': 'in_playlist',  # Chỉ lấy danh sách, không resolve format từng video
+}
+
+def search_result(entry):
+    title = entry.get('title') or ''
+    artist = parse_artist_from_title(title)
+    if artist == 'Unknown':
+        artist = entry.get('channel') or entry.get('uploader') or artist
+    return {
+        'title': title,
+        'artist': artist,
+        'video_id': entry['id'],
+        'duration': int(entry.get('duration') or 0),
+        'cover_url': f"https://i.ytimg.com/vi/{entry['id']}/hqdefault.jpg",
+    }
+
+async def search_youtube(normalized):
+    try:
+        with stage_seconds.time('search'):
+            entries = await extract_pool.run(ydl_search, normalized, SEARCH_RESULTS, SEARCH_OPTS)
+    except Exception as e:
+        logger.error(f"Search failed for '{normalized}': {e}")
+        return None
+    results = [search_result(entry) for entry in entries if entry.get('id')]
+    search_cache.put(normalized, results)
+    if results:
+        # Kết quả đầu = bài mà ytsearch1 của stream_pcm sẽ chọn
+        video_id_cache.set(query_alias(normalized), results[0]['video_id'])
+    logger.info(f"Search '{normalized}': {len(results)} results")
+    return results
+
+def run_search(normalized):
+    task = inflight_searches.get(normalized)
+    if task is None:
+        task = asyncio.create_task(search_youtube(normalized))
+        inflight_searches[normalized] = task
+        task.add_done_callback(functools.partial(forget_inflight, inflight_searches, normalized))
+    return task
+
 async def search_music(request):
-    pass
+    if request.method == 'POST':
+        try:
+            params = await request.json()
+        except ValueError:
+            return web.json_response({'error': 'Invalid JSON body'}, status=400)
+        if not isinstance(params, dict):
+            return web.json_response({'error': 'JSON body must be an object'}, status=400)
+    else:
+        params = request.query
+    query = params.get('query') or params.get('q') or params.get('song') or ''
+    if not isinstance(query, str):
+        return web.json_response({'error': 'Query must be a string'}, status=400)
+    try:
+        limit = max(1, min(int(params.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_RESULTS))
+    except (TypeError, ValueError):
+        limit = SEARCH_DEFAULT_LIMIT
+    
+    normalized = normalize_query(query)
+    if not normalized:
+        return web.json_response({'error': 'Missing query param'}, status=400)
+    
+    results = search_cache.get(normalized)
+    cached = results is not None
+    partial = False
+    if results is None:
+        # Đang gõ dần: lọc kết quả của tiền tố đã cache, search đầy đủ chạy nền
+        results = search_cache.prefix_match(normalized)
+        if results is not None:
+            partial = True
+            cache_lookups.inc('search', 'partial')
+            run_search(normalized)
+        else:
+            cache_lookups.inc('search', 'miss')
+            results = await run_search(normalized)
+            if results is None:
+                return web.json_response({'error': 'Search failed'}, status=502)
+    else:
+        cache_lookups.inc('search', 'hit')
+    
+    return web.json_response({
+        'success': True,
+        'query': query,
+        'cached': cached,
+        'partial': partial,
+        'results': results[:limit],
+    })
+
+# Prefetch hàng loạt (CLI `prefetch` hoặc POST /prefetch): resolve theo lô, tải ưu tiên thấp
+PREFETCH_BATCH_SIZE = 10
+PREFETCH_PARALLELISM = 2       # Số bài resolve/tải cùng lúc của một lượt prefetch
+PREFETCH_BANDWIDTH_KBPS = 512  # Tổng băng thông cho một lượt (KB/s), 0 = không giới hạn
+PREFETCH_MAX_QUERIES = 500
+PREFETCH_RUNS_KEPT = 16
+
+class PrefetchRun:
+    """Progress of one bulk prefetch: every query ends as cached, ready, failed or skipped."""
+    def __init__(self, queries, priority, parallelism, bandwidth_kbps):
+        self.id = hashlib.sha256(f"{time.time()}:{len(queries)}".encode()).hexdigest()[:12]
+        self.queries = queries  # [(query, video_id hoặc None)]
+        self.priority = priority
+        self.parallelism = max(1, parallelism)
+        # Chia đều tổng băng thông cho các download chạy song song
+        self.ratelimit = bandwidth_kbps * 1024 // self.parallelism if bandwidth_kbps > 0 else None
+        self.counts = {'cached': 0, 'ready': 0, 'failed': 0, 'skipped': 0}
+        self.started = time.time()
+        self.finished = None
+        self.task = None
+
+    def to_dict(self):
+        return {'id': self.id, 'total': len(self.queries), 'done': sum(self.counts.values()), **self.counts,
+                'priority': self.priority, 'started': self.started, 'finished': self.finished}
+
+prefetch_runs = OrderedDict()  # id -> PrefetchRun, giữ PREFETCH_RUNS_KEPT lượt gần nhất
+
+def ydl_playlist(url, ydl_opts):
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return [ydl.sanitize_info(entry) for entry in info.get('entries') or [] if entry]
+
+async def expand_prefetch_queries(queries=(), playlists=()):
+    items = [(q.strip(), None) for q in queries if q and q.strip()]
+    for url in playlists:
+        # Playlist: đã biết video id nên bỏ qua bước search
+        entries = await extract_pool.run(ydl_playlist, url, SEARCH_OPTS)
+        items += [(entry.get('title') or entry['id'], entry['id']) for entry in entries if entry.get('id')]
+    return items[:PREFETCH_MAX_QUERIES]
+
+async def prefetch_one(run, full_query, video_id):
+    alias = query_alias(full_query)
+    if video_id:
+        video_id_cache.set(alias, video_id)
+    for track_id in (cache_index.get_alias(alias) or video_id, alias, generate_hash(full_query)):
+        if track_id and has_cached_mp3(track_id):
+            return 'cached'
+    if len(download_scheduler.queued()) >= DOWNLOAD_QUEUE_MAX:
+        return 'skipped'  # Nhường chỗ trong queue cho người dùng
+    metadata = await get_music_metadata(full_query, alias, priority=run.priority, ratelimit=run.ratelimit)
+    if metadata['from_cache']:
+        return 'cached'
+    job = inflight_downloads.get(metadata['track_id'])
+    if job is None:
+        return 'ready' if has_cached_mp3(metadata['track_id']) else 'skipped'
+    state = await asyncio.shield(job.done)
+    return state if state in ('ready', 'failed') else 'skipped'
+
+async def run_prefetch(run):
+    semaphore = asyncio.Semaphore(run.parallelism)
+
+    async def one(full_query, video_id):
+        async with semaphore:
+            try:
+                result = await prefetch_one(run, full_query, video_id)
+            except Exception as e:
+                logger.warning(f"Prefetch failed for '{full_query}': {e}")
+                result = 'failed'
+            run.counts[result] += 1
 
-async def main():
+    logger.info(f"Prefetch {run.id}: {len(run.queries)} queries, parallelism {run.parallelism}, "
+                f"ratelimit {run.ratelimit or 'none'} B/s per download")
+    for start in range(0, len(run.queries), PREFETCH_BATCH_SIZE):
+        await asyncio.gather(*(one(q, v) for q, v in run.queries[start:start + PREFETCH_BATCH_SIZE]))
+        logger.info(f"Prefetch {run.id}: {run.to_dict()}")
+    run.finished = time.time()
+    return run
+
+def start_prefetch(run):
+    run.task = asyncio.create_task(run_prefetch(run))
+    prefetch_runs[run.id] = run
+    while len(prefetch_runs) > PREFETCH_RUNS_KEPT:
+        prefetch_runs.popitem(last=False)
+    return run
+
+async def prefetch(request):
+    if request.method == 'GET':
+        return web.json_response({'success': True, 'runs': [run.to_dict() for run in prefetch_runs.values()]})
+    try:
+        params = await request.json()
+    except ValueError:
+        return web.json_response({'error': 'Invalid JSON body'}, status=400)
+    if not isinstance(params, dict):
+        return web.json_response({'error': 'JSON body must be an object'}, status=400)
+    playlists = params.get('playlists') or ([params['playlist']] if params.get('playlist') else [])
+    queries = params.get('queries') or []
+    # Chuỗi đơn ("abc") sẽ bị duyệt từng ký tự: chỉ nhận list các chuỗi
+    if not all(isinstance(items, list) and all(isinstance(item, str) for item in items) for items in (queries, playlists)):
+        return web.json_response({'error': 'queries and playlists must be lists of strings'}, status=400)
+    try:
+        queries = await expand_prefetch_queries(queries, playlists)
+        parallelism = int(params.get('parallelism', PREFETCH_PARALLELISM))
+        bandwidth = int(params.get('bandwidth_kbps', PREFETCH_BANDWIDTH_KBPS))
+    except (TypeError, ValueError) as e:
+        return web.json_response({'error': f'Invalid prefetch params: {e}'}, status=400)
+    except Exception as e:
+        logger.error(f"Cannot expand prefetch playlist: {e}")
+        return web.json_response({'error': 'Playlist unavailable'}, status=502)
+    if not queries:
+        return web.json_response({'error': 'Missing queries or playlist'}, status=400)
+    priority = PRIORITY_PREFETCH if playlists else PRIORITY_WARMUP
+    run = start_prefetch(PrefetchRun(queries, priority, min(parallelism, DOWNLOAD_WORKERS), bandwidth))
+    return web.json_response({'success': True, **run.to_dict()}, status=202)
+
+async def prefetch_cli(argv):
+    global shared_cache
+    parser = argparse.ArgumentParser(prog='ServerMusic_4.3.py prefetch', description='Warm up the music cache')
+    parser.add_argument('file', nargs='?', help="File of queries, one per line (URL = playlist); '-' = stdin")
+    parser.add_argument('--playlist', action='append', default=[], help='YouTube playlist URL (repeatable)')
+    parser.add_argument('--parallel', type=int, default=PREFETCH_PARALLELISM)
+    parser.add_argument('--bandwidth', type=int, default=PREFETCH_BANDWIDTH_KBPS, help='Total KB/s, 0 = unlimited')
+    args = parser.parse_args(argv)
+    
+    lines = []
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    playlists = args.playlist + [line for line in lines if line.startswith(('http://', 'https://'))]
+    queries = [line for line in lines if not line.startswith(('http://', 'https://'))]
+    
+    # Chạy song song với server được: khoá track + index SQLite dùng chung, eviction để server lo
+    shared_cache = True
+    try:
+        items = await expand_prefetch_queries(queries, playlists)
+        priority = PRIORITY_PREFETCH if playlists else PRIORITY_WARMUP
+        run = start_prefetch(PrefetchRun(items, priority, min(args.parallel, DOWNLOAD_WORKERS), args.bandwidth))
+        await run.task
+        logger.info(f"Prefetch finished in {run.finished - run.started:.0f}s: {run.to_dict()}")
+    finally:
+        cache_index.flush_touches()
+        extract_pool.shutdown()
+        download_pool.shutdown()
+
+async def metrics(request):
+    queue_depth.set(len(download_scheduler.queued()), 'download')
+    queue_depth.set(ffmpeg_pool.queue_depth, 'ffmpeg')
+    queue_depth.set(extract_pool.pending, 'extract_pool')
+    queue_depth.set(download_pool.pending, 'download_pool')
+    queue_depth.set(len(inflight_metadata), 'metadata')
+    queue_depth.set(len(live_streams) + len(pcm_streams), 'live')
+    body = '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+    return web.Response(body=body.encode(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-store',
+    })
+
+class StageAccessLogger(web.AccessLogger):
+    """Access logger that also feeds the 'static' stage: aiohttp calls it once the response is fully sent."""
+    @property
+    def enabled(self):
+        return True
+
+    def log(self, request, response, time):
+        if request.path.startswith('/music_cache/'):
+            stage_seconds.observe(time, 'static')
+        if self.logger.isEnabledFor(logging.INFO):
+            super().log(request, response, time)
+
+def create_app():
     app = web.Application(middlewares=[auth_middleware])
+    app.on_response_prepare.append(apply_cache_headers)
+    app.on_response_prepare.append(count_bytes_served)
     
     app.router.add_post('/search', search_music)
     app.router.add_get('/search', search_music)
     app.router.add_get('/stream_pcm', stream_pcm)
+    app.router.add_get(f'/live/{{name:{RENDITION_PATTERN}}}', live_stream)
+    app.router.add_get('/status/{cache_filename:[A-Za-z0-9_-]+}', download_status)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/cover/{cache_filename:[A-Za-z0-9_-]+}', cover)
+    app.router.add_get('/prefetch', prefetch)
+    app.router.add_post('/prefetch', prefetch)
     
-    app.router.add_static('/music_cache/', path=CACHE_DIR, show_index=False)
+    app.router.add_get(f'/music_cache/{{name:[A-Za-z0-9_-]+\\.lrc|{RENDITION_PATTERN}}}', serve_cache_file)
+    return app
+
+async def main(worker=False):
+    global shared_cache
+    shared_cache = worker
+    if not worker:
+        await recover_cache()
+        cache_lru.load(cache_index)
+    await load_fallback_audio()
+    memory_sampler = asyncio.create_task(sample_memory())
+    index_flusher = asyncio.create_task(flush_index_touches())
     
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(create_app(), access_log_class=StageAccessLogger)
     await runner.setup()
-    site = web.TCPSite(runner, '192.168.1.17', 5005)
+    site = web.TCPSite(runner, '192.168.1.17', 5005, reuse_port=worker or None)
     await site.start()
     
-    logger.info("Server started on http://192.168.1.17:5005 (FFmpeg silence + loud beep, ID3 tag)")
+    logger.info(f"Server started on http://192.168.1.17:5005 (pid {os.getpid()}, in-memory beep + silence fallback, ID3 tag)")
     logger.info("Diy by me!")
     
-    await asyncio.Future()
+    try:
+        await asyncio.Future()
+    finally:
+        memory_sampler.cancel()
+        index_flusher.cancel()
+        cache_index.flush_touches()
+        if http_session is not None:
+            await http_session.close()
+        extract_pool.shutdown()
+        download_pool.shutdown()
+
+def run_worker():
+    asyncio.run(main(worker=True))
+
+def run_workers(count):
+    """Pre-fork supervisor: `count` server processes share the port via SO_REUSEPORT.
+
+    The supervisor runs the startup recovery scan once, restarts workers that
+    die, and owns cache eviction: every EVICT_INTERVAL it re-reads the shared
+    index (file sizes and last_access the workers wrote, no directory scan)
+    and evicts LRU tracks, skipping tracks a worker holds the lock of.
+    """
+    asyncio.run(recover_cache())
+    cache_lru.load(cache_index)
+    ctx = multiprocessing.get_context('spawn')  # không fork kết nối SQLite / thread pool
+    workers = {}
+    try:
+        while True:
+            for i in range(count):
+                proc = workers.get(i)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    logger.warning(f"Worker {i} exited with code {proc.exitcode}, restarting")
+                workers[i] = ctx.Process(target=run_worker, name=f"music-worker-{i}")
+                workers[i].start()
+            cache_index.reload()
+            cache_lru.sync(cache_index)
+            cache_lru.evict(protected=locked_tracks())
+            time.sleep(EVICT_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.join(5)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.argv[1:2] == ['prefetch']:
+        asyncio.run(prefetch_cli(sys.argv[2:]))
+    elif SERVER_WORKERS > 1 and fcntl is not None:
+        run_workers(SERVER_WORKERS)
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,468 @@
+"""Offline load test / benchmark cho ServerMusic_4.3.py.
+
+yt-dlp và FFmpeg được thay bằng bản giả cục bộ (delay cấu hình được, audio lấy
+từ file local), server chạy trong process con trên 127.0.0.1, N client giả lập
+ESP32 (X-Dynamic-Key hợp lệ) bắn hỗn hợp hit / miss / burst trùng / static.
+
+    python bench_music_server.py --clients 20 --duration 30 --output bench.json
+    python bench_music_server.py --baseline bench.json   # so sánh với lần chạy trước
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SERVER = os.path.join(HERE, 'ServerMusic_4.3.py')
+DEFAULT_MIX = 'hit=45,miss=10,burst=10,static=30,search=5'
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz: frame 417 byte, 26.1 ms (mutagen đọc được)
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+MP3_FRAME_SECONDS = 1152 / 44100
+
+# ===== Fakes (chạy trong process server) =====
+
+FAKE_FFMPEG = r'''#!{python}
+# FFmpeg giả cho benchmark: ghi file audio local ra mọi output (pipe:1 hoặc file) sau BENCH_FFMPEG_DELAY giây
+import os, sys, time
+args = sys.argv[1:]
+audio = open(os.environ['BENCH_AUDIO'], 'rb').read()
+delay = float(os.environ.get('BENCH_FFMPEG_DELAY', '0'))
+outputs = [args[i + 2] for i, a in enumerate(args[:-2]) if a == '-f' and not args[i + 2].startswith('-')]
+outputs = [o for o in outputs if not o.startswith(('sine', 'anull'))] or [args[-1]]
+for out in outputs:
+    if out.startswith('pipe:'):
+        chunks = [audio[i:i + 8192] for i in range(0, len(audio), 8192)]
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            time.sleep(delay / len(chunks))
+    else:
+        time.sleep(delay)
+        with open(out, 'wb') as f:
+            f.write(audio)
+'''
+
+
+def fake_video_id(query):
+    return hashlib.md5(query.lower().encode()).hexdigest()[:11]
+
+
+class FakeYoutubeDL:
+    """Deterministic stand-in for yt_dlp.YoutubeDL: same query -> same video id."""
+    extract_delay = 0.0
+    download_delay = 0.0
+    audio_path = None
+    audio_seconds = 0
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _entry(self, video_id, title):
+        return {
+            'id': video_id, 'title': title, 'uploader': 'Bench', 'channel': 'Bench',
+            'duration': int(self.audio_seconds), 'ext': 'webm', 'abr': 128,
+            'url': f"http://127.0.0.1:9/{video_id}.webm",
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'thumbnail': f"https://i.ytimg.com/vi/{video_id}/default.jpg",
+        }
+
+    def extract_info(self, url, download=False, **kwargs):
+        time.sleep(self.extract_delay)
+        match = re.match(r'ytsearch(\d*):(.*)', url)
+        if match:
+            count = int(match.group(1) or 1)
+            query = match.group(2)
+            entries = [self._entry(fake_video_id(query if i == 0 else f"{query}#{i}"), f"Bench - {query} {i}")
+                       for i in range(count)]
+            if download:
+                entries = [self.process_ie_result(entries[0])]
+            return {'_type': 'playlist', 'title': query, 'entries': entries}
+        video_id = url.rsplit('v=', 1)[-1]
+        info = self._entry(video_id, f"Bench - {video_id}")
+        return self.process_ie_result(info) if download else info
+
+    def process_ie_result(self, info, download=True):
+        time.sleep(self.download_delay)
+        template = self.opts.get('outtmpl')
+        if isinstance(template, dict):
+            template = template.get('default')
+        path = template.replace('%(ext)s', info.get('ext', 'webm'))
+        shutil.copyfile(self.audio_path, path)
+        return {**info, 'requested_downloads': [{'filepath': path}]}
+
+    @staticmethod
+    def sanitize_info(info):
+        return dict(info)
+
+
+def load_server_module(path):
+    spec = importlib.util.spec_from_file_location('server_music', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['server_music'] = module  # process pool unpickle hàm theo tên module
+    spec.loader.exec_module(module)
+    return module
+
+
+class LoopLagMonitor:
+    """Samples event-loop lag as the overshoot of a short periodic sleep."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+
+async def serve_async(args):
+    import psutil
+    import yt_dlp
+    from aiohttp import web
+
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    server = load_server_module(args.server)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        # Worker fork kế thừa FakeYoutubeDL đã patch
+        server.download_pool.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=server.DOWNLOAD_WORKERS, mp_context=multiprocessing.get_context('fork'))
+    server.cache_lru.load(server.cache_index)
+    await server.load_fallback_audio()
+
+    # Server cũ (--baseline) có thể chưa có StageAccessLogger
+    runner = web.AppRunner(server.create_app(), access_log_class=getattr(server, 'StageAccessLogger', web.AccessLogger))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+
+    process = psutil.Process()
+    rss = []
+    lag = LoopLagMonitor()
+    lag.start()
+
+    async def sample_rss():
+        while True:
+            rss.append(sum(p.memory_info().rss for p in [process, *process.children(recursive=True)]
+                           if p.is_running()))
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_rss())
+    print('READY', flush=True)
+    # Driver gửi một dòng khi xong; đọc fd thô vì worker fork sẽ close sys.stdin (kẹt nếu thread đang giữ lock)
+    await asyncio.to_thread(os.read, sys.stdin.fileno(), 1)
+
+    sampler.cancel()
+    lag.task.cancel()
+    print(json.dumps({
+        'loop_lag_ms': summarize([s * 1000 for s in lag.samples]),
+        'rss_mb': {'max': max(rss) / 2 ** 20 if rss else 0, 'final': rss[-1] / 2 ** 20 if rss else 0},
+    }), flush=True)
+    await runner.cleanup()
+    server.extract_pool.shutdown()
+    server.download_pool.shutdown()
+
+
+def serve(args):
+    os.chdir(args.workdir)
+    os.environ['PATH'] = os.path.join(args.workdir, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    os.environ['BENCH_AUDIO'] = args.audio
+    os.environ['BENCH_FFMPEG_DELAY'] = str(args.ffmpeg_delay)
+    FakeYoutubeDL.extract_delay = args.extract_delay
+    FakeYoutubeDL.download_delay = args.download_delay
+    FakeYoutubeDL.audio_path = args.audio
+    FakeYoutubeDL.audio_seconds = args.audio_seconds
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        filename=os.path.join(args.workdir, 'server.log'))
+    asyncio.run(serve_async(args))
+
+# ===== Driver =====
+
+def summarize(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+    return {'count': len(values), 'mean': sum(values) / len(values), 'p50': pct(50), 'p90': pct(90),
+            'p99': pct(99), 'max': values[-1]}
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        mix[op.strip()] = float(weight)
+    unknown = set(mix) - {'hit', 'miss', 'burst', 'static', 'search'}
+    if unknown:
+        raise SystemExit(f"Unknown ops in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def read_secret(server_path):
+    with open(server_path, encoding='utf-8') as f:
+        match = re.search(r'^SECRET_KEY = "(.*)"', f.read(), re.M)
+    return match.group(1)
+
+
+def write_audio(path, seconds):
+    with open(path, 'wb') as f:
+        f.write(MP3_FRAME * int(seconds / MP3_FRAME_SECONDS))
+
+
+class Device:
+    """One simulated ESP32: fixed MAC/chip id, fresh X-Dynamic-Key per request."""
+    def __init__(self, index, secret):
+        self.mac = f"24:6F:28:{index >> 16 & 255:02X}:{index >> 8 & 255:02X}:{index & 255:02X}"
+        self.chip_id = str(100000 + index)
+        self.secret = secret
+
+    def headers(self):
+        timestamp = int(time.time())
+        data = f"{self.mac}:{self.chip_id}:{timestamp}:{self.secret}"
+        return {
+            'X-MAC-Address': self.mac,
+            'X-Chip-ID': self.chip_id,
+            'X-Timestamp': str(timestamp),
+            'X-Dynamic-Key': hashlib.sha256(data.encode()).hexdigest()[:32].upper(),
+        }
+
+
+class Bench:
+    def __init__(self, args, base_url, secret):
+        self.args = args
+        self.base_url = base_url
+        self.secret = secret
+        self.latencies = {}   # op -> [giây]
+        self.errors = {}
+        self.bytes = 0
+        self.requests = 0
+        self.misses = 0
+        self.warm_songs = [f"warm song {i}" for i in range(args.catalog)]
+        self.static_urls = []
+
+    async def timed(self, session, op, device, path, **params):
+        start = time.perf_counter()
+        try:
+            async with session.get(self.base_url + path, params=params or None, headers=device.headers()) as resp:
+                body = await resp.read()
+                ok = resp.status < 400
+        except aiohttp.ClientError:
+            body, ok = b'', False
+        self.latencies.setdefault(op, []).append(time.perf_counter() - start)
+        self.requests += 1
+        self.bytes += len(body)
+        if not ok:
+            self.errors[op] = self.errors.get(op, 0) + 1
+        return body
+
+    async def warm_up(self, session):
+        device = Device(0, self.secret)
+        for song in self.warm_songs:
+            body = await self.timed(session, 'warmup', device, '/stream_pcm', song=song)
+            track_id = json.loads(body)['track_id']
+            await self.timed(session, 'warmup', device, f"/status/{track_id}", wait=30, state='queued')
+            for _ in range(60):
+                status = json.loads(await self.timed(session, 'warmup', device, f"/status/{track_id}",
+                                                     wait=5, state='downloading'))
+                if status.get('ready') or status.get('state') in ('failed', 'dropped'):
+                    break
+            self.static_urls.append(f"/music_cache/{track_id}.mp3")
+        self.latencies.pop('warmup', None)
+        self.errors.pop('warmup', None)
+
+    def new_song(self):
+        self.misses += 1
+        return f"cold song {self.misses} {random.random():.6f}"
+
+    async def client(self, session, index, deadline):
+        device = Device(index, self.secret)
+        ops, weights = zip(*self.args.mix.items())
+        while time.perf_counter() < deadline:
+            op = random.choices(ops, weights)[0]
+            if op == 'hit':
+                await self.timed(session, op, device, '/stream_pcm', song=random.choice(self.warm_songs))
+            elif op == 'miss':
+                await self.timed(session, op, device, '/stream_pcm', song=self.new_song())
+            elif op == 'burst':
+                # Nhiều loa cùng xin một bài mới cùng lúc (kiểm tra single-flight)
+                song = self.new_song()
+                await asyncio.gather(*(self.timed(session, op, Device(index * 100 + i, self.secret), '/stream_pcm',
+                                                  song=song) for i in range(self.args.burst_size)))
+            elif op == 'static':
+                await self.timed(session, op, device, random.choice(self.static_urls))
+            elif op == 'search':
+                await self.timed(session, op, device, '/search', q=random.choice(self.warm_songs)[:8])
+            if self.args.think:
+                await asyncio.sleep(random.expovariate(1000 / self.args.think))
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await self.warm_up(session)
+            self.requests = self.bytes = 0
+            start = time.perf_counter()
+            deadline = start + self.args.duration
+            await asyncio.gather(*(self.client(session, i + 1, deadline) for i in range(self.args.clients)))
+            elapsed = time.perf_counter() - start
+            async with session.get(self.base_url + '/metrics') as resp:
+                metrics = parse_metrics(await resp.text())
+        return {
+            'elapsed_s': elapsed,
+            'requests': self.requests,
+            'throughput_rps': self.requests / elapsed,
+            'bytes': self.bytes,
+            'ops': {op: {**summarize([v * 1000 for v in values]), 'errors': self.errors.get(op, 0)}
+                    for op, values in sorted(self.latencies.items())},
+            'server_metrics': metrics,
+        }
+
+
+def parse_metrics(text):
+    # Chỉ lấy counter hit/miss và tổng/số lần của từng stage
+    result = {}
+    for line in text.splitlines():
+        match = re.match(r'(music_cache_lookups_total|music_stage_duration_seconds_(?:sum|count))\{(.*)\} (\S+)', line)
+        if match:
+            result[f"{match.group(1)}{{{match.group(2)}}}"] = float(match.group(3))
+    return result
+
+
+def compare(report, baseline):
+    print(f"\nvs baseline ({baseline['timestamp']}):")
+    old, new = baseline['results'], report['results']
+    rows = [('throughput_rps', old['throughput_rps'], new['throughput_rps'])]
+    for op, stats in new['ops'].items():
+        if op in old['ops'] and stats.get('count') and old['ops'][op].get('count'):
+            rows += [(f"{op} p50 ms", old['ops'][op]['p50'], stats['p50']),
+                     (f"{op} p99 ms", old['ops'][op]['p99'], stats['p99'])]
+    rows.append(('loop lag p99 ms', baseline['server']['loop_lag_ms'].get('p99', 0), report['server']['loop_lag_ms'].get('p99', 0)))
+    rows.append(('rss max MB', baseline['server']['rss_mb']['max'], report['server']['rss_mb']['max']))
+    for name, before, after in rows:
+        delta = (after - before) / before * 100 if before else 0
+        print(f"  {name:<22} {before:>10.2f} -> {after:>10.2f} ({delta:+.1f}%)")
+
+
+def print_report(report):
+    results, server = report['results'], report['server']
+    print(f"\n{results['requests']} requests in {results['elapsed_s']:.1f}s = {results['throughput_rps']:.1f} req/s, "
+          f"{results['bytes'] / 2 ** 20:.1f} MB")
+    print(f"{'op':<8} {'count':>6} {'err':>5} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for op, stats in results['ops'].items():
+        if stats.get('count'):
+            print(f"{op:<8} {stats['count']:>6} {stats['errors']:>5} {stats['p50']:>9.1f} {stats['p99']:>9.1f} {stats['max']:>9.1f}")
+    lag = server['loop_lag_ms']
+    print(f"loop lag: p50 {lag.get('p50', 0):.2f} ms, p99 {lag.get('p99', 0):.2f} ms, max {lag.get('max', 0):.2f} ms; "
+          f"RSS max {server['rss_mb']['max']:.1f} MB (server + ffmpeg/download children)")
+
+
+def drive(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='music_bench_')
+    os.makedirs(os.path.join(workdir, 'bin'))
+    ffmpeg = os.path.join(workdir, 'bin', 'ffmpeg')
+    with open(ffmpeg, 'w') as f:
+        f.write(FAKE_FFMPEG.replace('{python}', sys.executable))
+    os.chmod(ffmpeg, 0o755)
+    if args.audio is None:
+        args.audio = os.path.join(workdir, 'bench_audio.mp3')
+        write_audio(args.audio, args.audio_seconds)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--workdir', workdir, '--port', str(port),
+               '--server', os.path.abspath(args.server), '--audio', os.path.abspath(args.audio),
+               '--audio-seconds', str(args.audio_seconds), '--extract-delay', str(args.extract_delay),
+               '--download-delay', str(args.download_delay), '--ffmpeg-delay', str(args.ffmpeg_delay)]
+    if args.quiet:
+        command.append('--quiet')
+    server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        if server.stdout.readline().strip() != 'READY':
+            raise SystemExit(f"Server failed to start, see {workdir}/server.log")
+        results = asyncio.run(Bench(args, f"http://127.0.0.1:{port}", read_secret(args.server)).run())
+        server.stdin.write('stop\n')
+        server.stdin.flush()
+        server_stats = json.loads(server.stdout.readline())
+    finally:
+        server.stdin.close()
+        server.wait(30)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('baseline', 'output')},
+        'results': results,
+        'server': server_stats,
+    }
+    print_report(report)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare(report, json.load(f))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {args.output}")
+    if args.keep:
+        print(f"Work dir kept: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for ServerMusic_4.3.py')
+    parser.add_argument('--server', default=DEFAULT_SERVER, help='Path to the server script')
+    parser.add_argument('--clients', type=int, default=20, help='Simulated ESP32 devices')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load after warm-up')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Op weights (default {DEFAULT_MIX})")
+    parser.add_argument('--catalog', type=int, default=10, help='Songs pre-cached during warm-up (hit/static targets)')
+    parser.add_argument('--burst-size', type=int, default=5, help='Concurrent identical requests per burst')
+    parser.add_argument('--think', type=float, default=0, help='Mean think time between requests (ms)')
+    parser.add_argument('--extract-delay', type=float, default=0.3, help='Fake yt-dlp extract/search delay (s)')
+    parser.add_argument('--download-delay', type=float, default=1.0, help='Fake yt-dlp download delay (s)')
+    parser.add_argument('--ffmpeg-delay', type=float, default=0.3, help='Fake FFmpeg run time (s)')
+    parser.add_argument('--audio', help='Local MP3 used as every download/transcode output (default: synthetic)')
+    parser.add_argument('--audio-seconds', type=float, default=30, help='Length of the synthetic MP3')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='Previous results JSON to compare against')
+    parser.add_argument('--quiet', action='store_true', help='Server logs at WARNING instead of INFO')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary cache/work dir')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        drive(args)
+
+
+if __name__ == '__main__':
+    main()
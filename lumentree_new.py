@@ -1,11 +1,16 @@
-import requests
+import asyncio
+import copy
+import heapq
 import json
-import paho.mqtt.client as mqtt
-import time
-import threading
+import os
 import random
+import time
+from array import array
 from datetime import datetime
 
+import aiohttp
+import paho.mqtt.client as mqtt
+
 # Thông tin API
 SERVER_HOST = "https://lumentree.net"
 DEVICE_ID = "H240805202"
@@ -17,26 +22,228 @@ MQTT_USER = "MQTT"
 MQTT_PASSWORD = "123456"
 CLIENT_ID = "LumenTree"
 
+# Danh sách inverter chạy chung một process / một kết nối MQTT / một pool HTTP.
+# topic: namespace MQTT + HA device id (mặc định LumenTree_<device_id>), name: tiền tố tên sensor trong HA.
+# Inverter đầu giữ namespace "LumenTree" cũ để entity HA sẵn có không bị đổi.
+DEVICES = [
+    {"device_id": DEVICE_ID, "topic": CLIENT_ID, "name": "LumenTree"},
+    # {"device_id": "H2408xxxxx", "name": "LumenTree Kho"},
+]
+
 # Biến toàn cục
-last_timestamp = ""
-last_api_fetch_time = 0
-API_FETCH_INTERVAL = 180  # 180 giây cho energy totals
-last_session_refresh_time = 0
-SESSION_REFRESH_INTERVAL = 3600  # 60 phút
-api_session = requests.Session()
+API_FETCH_INTERVAL = 1800  # Giây, đối soát energy với API ngày (giữa các lần dùng tích phân cục bộ)
+API_FETCH_JITTER = 5  # Giây, lệch ngẫu nhiên mỗi lần gọi API ngày
 
 # Realtime polling
 REALTIME_POLL_INTERVAL = 2  # Giây, match JS loadRealtime()
-last_realtime_fetch_time = 0
+REALTIME_JITTER = 0.1  # Giây
+
+# Publish MQTT: chỉ gửi khi giá trị đổi quá deadband, hoặc đã im lặng quá HEARTBEAT_INTERVAL.
+# Ngưỡng = max(abs, pct% của giá trị đã publish); SENSOR_DEADBANDS ghi đè theo tên sensor.
+DEADBANDS = {
+    "power": {"abs": 20, "pct": 2},  # W
+    "current": {"abs": 0.2, "pct": 2},  # A
+    "voltage": {"abs": 1},  # V
+    "temperature": {"abs": 0.5},  # °C
+    "battery": {"abs": 0.5},  # % (số nguyên: ngưỡng dưới 1 bước để 50 -> 51 vẫn publish)
+    "frequency": {"abs": 0.05},  # Hz
+    "energy": {"abs": 0.01},  # kWh
+}
+SENSOR_DEADBANDS = {
+    "batteryVoltage": {"abs": 0.2},
+}
+HEARTBEAT_INTERVAL = 300  # Giây im lặng tối đa mỗi sensor, sau đó publish lại dù không đổi
+# True: mỗi inverter publish một JSON duy nhất lên <topic>/state, discovery dùng value_template
+STATE_JSON = False
+
+# Tổng energy trong ngày tích phân cục bộ (hình thang) từ công suất realtime; API ngày chỉ để đối soát.
+# (counter energy, sensor công suất nguồn, dấu): công suất sau khi nhân dấu mà âm thì tính 0
+BATTERY_DISCHARGE_POSITIVE = True  # batteryPower > 0 khi pin xả; đổi nếu inverter báo ngược dấu
+ENERGY_COUNTERS = [
+    ("pvTotal", "pvTotalPower", 1),
+    ("batCharge", "batteryValue", -1 if BATTERY_DISCHARGE_POSITIVE else 1),
+    ("batDischarge", "batteryValue", 1 if BATTERY_DISCHARGE_POSITIVE else -1),
+    ("loadTotal", "loadValue", 1),
+    ("gridTotal", "gridValue", 1),  # Chỉ chiều mua từ lưới
+    ("essentialTotal", "essentialValue", 1),
+]
+ENERGY_MAX_GAP = 30  # Giây; khoảng trống dài hơn (API lỗi) không tích phân, lần đối soát sau bù
+ENERGY_GAIN_MIN_DELTA = 1.0  # kWh API phải tăng trước khi hiệu chỉnh hệ số drift
+ENERGY_GAIN_LIMITS = (0.5, 1.5)
+ENERGY_STATE_FILE = "lumentree_energy.json"  # Lưu tổng energy qua restart (None = không lưu)
+ENERGY_SAVE_INTERVAL = 60  # Giây
+ENERGY_STATE_FIELDS = ("energy_date", "energy", "energy_raw", "energy_gain", "energy_anchor", "energy_ready")
+
+# HTTP: một ClientSession + connection pool keep-alive dùng chung cho mọi request
+API_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Origin": "https://lumentree.net",
+    "Accept": "application/json"
+}
+HTTP_POOL_SIZE = 8  # Kết nối đồng thời tối đa tới lumentree.net cho cả fleet
+HTTP_KEEPALIVE = 60  # Giây giữ kết nối TLS rảnh
+API_RATE_LIMIT = 20  # Request/giây tối đa cho cả fleet
+api_session = None  # aiohttp.ClientSession, tạo trong main() khi đã có event loop
+api_limiter = None  # RateLimiter, tạo trong main()
+
+# Khi mất broker: mẫu realtime gộp trung bình theo BUFFER_RESOLUTION giây vào ring buffer cố định
+# (BUFFER_CAPACITY dòng / inverter, ~110 KB), reconnect thì phát lại theo thứ tự lên <topic>/backlog
+BUFFER_RESOLUTION = 60  # Giây mỗi dòng backlog
+BUFFER_CAPACITY = 1440  # Dòng, 24 giờ ở 60 giây; đầy thì ghi đè dòng cũ nhất
+BUFFER_DIR = None  # Thư mục lưu backlog qua restart (None = chỉ trong RAM)
+BACKLOG_CHUNK = 60  # Dòng mỗi message replay
+BACKLOG_PACE = 0.2  # Giây nghỉ giữa các message replay
+MQTT_MAX_QUEUED = 1000  # Giới hạn hàng đợi nội bộ của paho
+
+# (measurement, name, nhãn); tên hiển thị trong HA = "<tên inverter> <nhãn>"
+SENSORS = [
+    ("energy", "pvTotal", "PV Total Energy"),
+    ("energy", "batCharge", "Battery Charge Energy"),
+    ("energy", "batDischarge", "Battery Discharge Energy"),
+    ("energy", "loadTotal", "Load Total Energy"),
+    ("energy", "gridTotal", "Grid Total Energy"),
+    ("energy", "essentialTotal", "Essential Load Energy"),
+    ("temperature", "deviceTempValue", "Device Temperature"),
+    ("power", "essentialValue", "Essential Load"),
+    ("power", "gridValue", "Grid Value"),
+    ("power", "loadValue", "Load Value"),
+    ("power", "pv1Power", "PV1 Power"),
+    ("power", "pv2Power", "PV2 Power"),
+    ("power", "pvTotalPower", "Total PV Power"),
+    ("power", "batteryValue", "Battery Power"),
+    ("power", "InverterPower", "Inverter Power"),
+    ("battery", "batteryPercent", "Battery Percentage"),
+    ("voltage", "batteryVoltage", "Battery Voltage"),
+    ("voltage", "gridVoltageValue", "Grid Voltage"),
+    ("voltage", "pvVoltage", "PV Voltage"),
+    ("current", "pvCurrent", "PV Current"),
+    ("current", "gridCurrent", "Grid Current"),
+    ("current", "batteryCurrent", "Battery Current"),
+    ("current", "InverterCurrent", "Inverter Current"),
+    ("frequency", "Gird_Frequency", "Gird Frequency"),
+]
+
+# Sensor realtime được lưu trong backlog (energy là tổng tích lũy, chỉ cần giá trị mới nhất)
+BACKLOG_FIELDS = [name for measurement, name, label in SENSORS if measurement != "energy"]
+BACKLOG_INDEX = {name: index for index, name in enumerate(BACKLOG_FIELDS)}
+
+class SampleRing:
+    """Fixed-capacity ring of timestamped rows backed by flat arrays (float64 time, float32 values)."""
+    def __init__(self, fields, capacity):
+        self.fields = fields
+        self.width = len(fields)
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("f", bytes(4 * capacity * self.width))
+        self.start = 0
+        self.count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, row):
+        if self.count == self.capacity:
+            self.pop(1)
+            self.dropped += 1
+        index = (self.start + self.count) % self.capacity
+        self.times[index] = timestamp
+        self.values[index * self.width:(index + 1) * self.width] = array("f", row)
+        self.count += 1
+
+    def peek(self, limit):
+        rows = []
+        for offset in range(min(limit, self.count)):
+            index = (self.start + offset) % self.capacity
+            rows.append((self.times[index], self.values[index * self.width:(index + 1) * self.width].tolist()))
+        return rows
+
+    def pop(self, count):
+        count = min(count, self.count)
+        self.start = (self.start + count) % self.capacity
+        self.count -= count
+
+    def save(self, path):
+        if not self.count:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        rows = self.peek(self.count)
+        header = json.dumps({"fields": self.fields, "count": len(rows)}).encode()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(len(header).to_bytes(4, "little") + header)
+            array("d", [timestamp for timestamp, values in rows]).tofile(f)
+            array("f", [value for timestamp, values in rows for value in values]).tofile(f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.read(int.from_bytes(f.read(4), "little")))
+            if header["fields"] != self.fields:
+                raise ValueError("danh sách sensor đã đổi")
+            times = array("d")
+            times.fromfile(f, header["count"])
+            values = array("f")
+            values.fromfile(f, header["count"] * self.width)
+        for row, timestamp in enumerate(times):
+            self.append(timestamp, values[row * self.width:(row + 1) * self.width])
+
+class Inverter:
+    """One inverter of the fleet: its own topic namespace and polling state."""
+    def __init__(self, device_id, topic=None, name=None):
+        self.device_id = device_id
+        self.topic = topic or f"{CLIENT_ID}_{device_id}"
+        self.name = name or f"LumenTree {device_id}"
+        self.last_timestamp = ""
+        self.values = {}  # (measurement, name) -> giá trị mới nhất
+        self.published = {}  # (measurement, name) -> (giá trị, time.monotonic()) lần publish gần nhất
+        self.mqtt_generation = 0  # Lần connect MQTT đã đồng bộ state
+        self.backlog = SampleRing(BACKLOG_FIELDS, BUFFER_CAPACITY)
+        self.bucket_start = None  # Đầu khoảng BUFFER_RESOLUTION đang gộp
+        self.bucket_sums = [0.0] * len(BACKLOG_FIELDS)
+        self.bucket_counts = [0] * len(BACKLOG_FIELDS)
+        self.replay_task = None
+        self.api_failures = 0  # Số lần realtime API lỗi liên tiếp
+        self.api_down_since = None
+        self.energy_date = None  # Ngày (YYYY-MM-DD) của các tổng energy
+        self.energy = {}  # counter -> kWh đã publish (đã nhân hệ số, kéo lên theo API)
+        self.energy_raw = {}  # counter -> kWh tích phân thô trong ngày
+        self.energy_gain = {}  # counter -> hệ số hiệu chỉnh drift, giữ qua các ngày
+        self.energy_anchor = {}  # counter -> [kWh API, kWh thô] ở lần hiệu chỉnh trước
+        self.energy_ready = False  # Chưa có mốc tin cậy (file/API) thì chưa publish energy
+        self.last_power_time = None
+        self.last_powers = {}
+
+inverters = [Inverter(**device) for device in DEVICES]
+
+class RateLimiter:
+    """Spaces acquisitions at least 1/rate seconds apart across all callers."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
 # MQTT client
 mqtt_client = mqtt.Client(client_id=CLIENT_ID)
+mqtt_client.max_queued_messages_set(MQTT_MAX_QUEUED)
+mqtt_generation = 0  # Tăng mỗi lần connect (paho thread), publish_sensors so sánh để đồng bộ lại
 
 # Hàm kết nối MQTT
 def on_connect(client, userdata, flags, rc, properties=None):
+    global mqtt_generation
     if rc == 0:
         print("Đã kết nối tới MQTT Broker")
-        publish_discovery_sensors()
+        mqtt_generation += 1
+        for inverter in inverters:
+            publish_discovery_sensors(inverter)
     else:
         print(f"Kết nối thất bại, mã lỗi: {rc}")
 
@@ -48,7 +255,7 @@ mqtt_client.on_message = on_message
 mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 
 # Hàm gửi thông tin khám phá cảm biến (giữ nguyên)
-def publish_discovery_sensor(sensor_measurement, sensor_name, friendly_name=""):
+def publish_discovery_sensor(inverter, sensor_measurement, sensor_name, friendly_name=""):
     sensor_units = {
         "temperature": "°C",
         "power": "W",
@@ -59,93 +266,252 @@ def publish_discovery_sensor(sensor_measurement, sensor_name, friendly_name=""):
         "frequency": "Hz"
     }.get(sensor_measurement, "")
 
-    discovery_topic = f"homeassistant/sensor/{CLIENT_ID}_{sensor_measurement}_{sensor_name}/config"
-    state_topic = f"{CLIENT_ID}/{sensor_measurement}/{sensor_name}"
+    discovery_topic = f"homeassistant/sensor/{inverter.topic}_{sensor_measurement}_{sensor_name}/config"
+    state_topic = state_json_topic(inverter) if STATE_JSON else f"{inverter.topic}/{sensor_measurement}/{sensor_name}"
     if not friendly_name:
-        friendly_name = f"{CLIENT_ID} {sensor_name} {sensor_measurement}"
+        friendly_name = f"{inverter.name} {sensor_name} {sensor_measurement}"
 
     payload = {
         "name": friendly_name,
         "state_topic": state_topic,
         "unit_of_measurement": sensor_units,
         "device_class": sensor_measurement,
-        "unique_id": f"{CLIENT_ID}_{sensor_measurement}_{sensor_name}",
+        "unique_id": f"{inverter.topic}_{sensor_measurement}_{sensor_name}",
         "device": {
-            "identifiers": [CLIENT_ID],
-            "name": CLIENT_ID,
+            "identifiers": [inverter.topic],
+            "name": inverter.name,
+            "serial_number": inverter.device_id,
             "manufacturer": "LumenTree",
             "model": "Energy Monitor"
         }
     }
+    if STATE_JSON:
+        payload["value_template"] = f"{{{{ value_json.{sensor_name} }}}}"
 
     mqtt_client.publish(discovery_topic, json.dumps(payload), retain=True)
-    print(f"Published discovery for sensor {sensor_name}")
-
-# Gửi tất cả thông tin khám phá cảm biến (giữ nguyên)
-def publish_discovery_sensors():
-    sensors = [
-        ("energy", "pvTotal", "LumenTree PV Total Energy"),
-        ("energy", "batCharge", "LumenTree Battery Charge Energy"),
-        ("energy", "batDischarge", "LumenTree Battery Discharge Energy"),
-        ("energy", "loadTotal", "LumenTree Load Total Energy"),
-        ("energy", "gridTotal", "LumenTree Grid Total Energy"),
-        ("energy", "essentialTotal", "LumenTree Essential Load Energy"),
-        ("temperature", "deviceTempValue", "LumenTree Device Temperature"),
-        ("power", "essentialValue", "LumenTree Essential Load"),
-        ("power", "gridValue", "LumenTree Grid Value"),
-        ("power", "loadValue", "LumenTree Load Value"),
-        ("power", "pv1Power", "LumenTree PV1 Power"),
-        ("power", "pv2Power", "LumenTree PV2 Power"),
-        ("power", "pvTotalPower", "LumenTree Total PV Power"),
-        ("power", "batteryValue", "LumenTree Battery Power"),
-        ("power", "InverterPower", "LumenTree Inverter Power"),
-        ("battery", "batteryPercent", "LumenTree Battery Percentage"),
-        ("voltage", "batteryVoltage", "LumenTree Battery Voltage"),
-        ("voltage", "gridVoltageValue", "LumenTree Grid Voltage"),
-        ("voltage", "pvVoltage", "LumenTree PV Voltage"),
-        ("current", "pvCurrent", "LumenTree PV Current"),
-        ("current", "gridCurrent", "LumenTree Grid Current"),
-        ("current", "batteryCurrent", "LumenTree Battery Current"),
-        ("current", "InverterCurrent", "LumenTree Inverter Current"),
-        ("frequency", "Gird_Frequency", "LumenTree Gird Frequency"),
-    ]
-    for sensor in sensors:
-        publish_discovery_sensor(*sensor)
+    print(f"[{inverter.device_id}] Published discovery for sensor {sensor_name}")
+
+# Gửi tất cả thông tin khám phá cảm biến của một inverter
+def publish_discovery_sensors(inverter):
+    for measurement, name, label in SENSORS:
+        publish_discovery_sensor(inverter, measurement, name, f"{inverter.name} {label}")
 
 # Hàm gửi dữ liệu cảm biến (giữ nguyên)
-def send_data_sensor(sensor_measurement, sensor_name, value):
-    state_topic = f"{CLIENT_ID}/{sensor_measurement}/{sensor_name}"
+def send_data_sensor(inverter, sensor_measurement, sensor_name, value):
+    state_topic = f"{inverter.topic}/{sensor_measurement}/{sensor_name}"
     mqtt_client.publish(state_topic, str(value), retain=True)
 
-# Hàm làm mới session (giữ nguyên)
-def refresh_api_session():
-    global api_session, last_session_refresh_time
-    api_session.close()
-    api_session = requests.Session()
-    last_session_refresh_time = time.time()
-    print("Đã làm mới phiên API")
-
-# Hàm lấy dữ liệu energy totals từ API ngày (giữ nguyên, đã hoạt động)
-def fetch_api_data():
-    global last_api_fetch_time, last_session_refresh_time, api_session
-    if time.time() - last_api_fetch_time < API_FETCH_INTERVAL:
+def state_json_topic(inverter):
+    return f"{inverter.topic}/state"
+
+def backlog_topic(inverter):
+    return f"{inverter.topic}/backlog"
+
+def backlog_path(inverter):
+    return os.path.join(BUFFER_DIR, f"{inverter.device_id}.backlog")
+
+# Gộp mẫu vào khoảng BUFFER_RESOLUTION hiện tại; sang khoảng mới thì đẩy dòng trung bình vào ring
+def buffer_sample(inverter, readings):
+    now = time.time()
+    bucket = now - now % BUFFER_RESOLUTION
+    if inverter.bucket_start != bucket:
+        flush_bucket(inverter)
+        inverter.bucket_start = bucket
+    for measurement, name, value in readings:
+        index = BACKLOG_INDEX.get(name)
+        if index is not None:
+            inverter.bucket_sums[index] += value
+            inverter.bucket_counts[index] += 1
+
+def flush_bucket(inverter):
+    if inverter.bucket_start is None:
         return
+    row = [total / count if count else float("nan") for total, count in zip(inverter.bucket_sums, inverter.bucket_counts)]
+    inverter.backlog.append(inverter.bucket_start, row)
+    inverter.bucket_start = None
+    inverter.bucket_sums = [0.0] * len(BACKLOG_FIELDS)
+    inverter.bucket_counts = [0] * len(BACKLOG_FIELDS)
+    if BUFFER_DIR:
+        inverter.backlog.save(backlog_path(inverter))
+
+# Phát backlog theo thứ tự thời gian, từng chunk QoS 1; mất kết nối giữa chừng thì giữ phần còn lại
+async def replay_backlog(inverter):
+    total = len(inverter.backlog)
+    print(f"[{inverter.device_id}] Phát lại {total} dòng backlog ({inverter.backlog.dropped} dòng cũ đã bị ghi đè)")
+    while len(inverter.backlog) and mqtt_client.is_connected():
+        rows = inverter.backlog.peek(BACKLOG_CHUNK)
+        payload = {
+            "fields": BACKLOG_FIELDS,
+            "resolution": BUFFER_RESOLUTION,
+            "rows": [[int(timestamp), *(None if value != value else round(value, 3) for value in values)]
+                     for timestamp, values in rows],
+        }
+        info = mqtt_client.publish(backlog_topic(inverter), json.dumps(payload), qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            break
+        inverter.backlog.pop(len(rows))
+        await asyncio.sleep(BACKLOG_PACE)
+    inverter.backlog.dropped = 0
+    if BUFFER_DIR:
+        inverter.backlog.save(backlog_path(inverter))
+    print(f"[{inverter.device_id}] Đã phát lại {total - len(inverter.backlog)}/{total} dòng backlog")
+
+def start_replay(inverter):
+    flush_bucket(inverter)
+    if len(inverter.backlog) and (inverter.replay_task is None or inverter.replay_task.done()):
+        inverter.replay_task = asyncio.create_task(replay_backlog(inverter))
+
+def deadband_exceeded(measurement, name, old, new):
+    band = SENSOR_DEADBANDS.get(name) or DEADBANDS.get(measurement, {})
+    threshold = max(band.get("abs", 0), abs(old) * band.get("pct", 0) / 100)
+    return abs(new - old) > threshold
+
+# Ghi nhận giá trị mới, chỉ publish sensor đổi quá deadband hoặc tới hạn heartbeat.
+# Trả về (số sensor publish, số sensor nhận).
+def publish_sensors(inverter, readings):
+    now = time.monotonic()
+    for measurement, name, value in readings:
+        inverter.values[(measurement, name)] = value
+    if not mqtt_client.is_connected():
+        # Không đẩy vào hàng đợi paho khi mất broker, gộp vào backlog có giới hạn
+        buffer_sample(inverter, readings)
+        return 0, len(readings)
+    if inverter.mqtt_generation != mqtt_generation:
+        # Vừa (re)connect: gửi lại toàn bộ state hiện tại và phát backlog đã tích lũy
+        inverter.mqtt_generation = mqtt_generation
+        inverter.published.clear()
+        start_replay(inverter)
+
+    changed = []
+    for measurement, name, value in readings:
+        key = (measurement, name)
+        last = inverter.published.get(key)
+        if last is None or now - last[1] >= HEARTBEAT_INTERVAL or deadband_exceeded(measurement, name, last[0], value):
+            changed.append(key)
+
+    if STATE_JSON:
+        # Một message mang mọi giá trị đã biết (kể cả energy từ API ngày)
+        if changed:
+            payload = {name: value for (measurement, name), value in inverter.values.items()}
+            mqtt_client.publish(state_json_topic(inverter), json.dumps(payload), retain=True)
+            inverter.published.update((key, (value, now)) for key, value in inverter.values.items())
+    else:
+        for key in changed:
+            send_data_sensor(inverter, *key, inverter.values[key])
+            inverter.published[key] = (inverter.values[key], now)
+    return len(changed), len(readings)
+
+def reset_energy(inverter, day, ready):
+    inverter.energy_date = day
+    inverter.energy = {counter: 0.0 for counter, source, sign in ENERGY_COUNTERS}
+    inverter.energy_raw = dict(inverter.energy)
+    inverter.energy_anchor = {}
+    inverter.energy_ready = ready
+
+# Sang ngày mới thì về 0; chỉ tin số 0 đó khi bridge chạy liên tục qua nửa đêm
+def roll_energy_day(inverter):
+    today = datetime.now().strftime("%Y-%m-%d")
+    if inverter.energy_date != today:
+        ready = inverter.energy_date is not None and inverter.last_power_time is not None
+        reset_energy(inverter, today, ready)
+        print(f"[{inverter.device_id}] Energy ngày {today} bắt đầu từ {'0' if ready else 'mốc API'}")
+    return today
+
+def integrate_energy(inverter, readings):
+    roll_energy_day(inverter)
+    now = time.monotonic()
+    power = {name: value for measurement, name, value in readings if measurement == "power"}
+    powers = {counter: max(sign * power.get(source, 0), 0) for counter, source, sign in ENERGY_COUNTERS}
+    if inverter.last_power_time is not None:
+        elapsed = now - inverter.last_power_time
+        if elapsed <= ENERGY_MAX_GAP:
+            for counter, previous in inverter.last_powers.items():
+                kwh = (previous + powers[counter]) / 2 * elapsed / 3600 / 1000
+                inverter.energy_raw[counter] += kwh
+                inverter.energy[counter] += kwh * inverter.energy_gain.get(counter, 1.0)
+        else:
+            # Tích phân thô bị hụt, không còn so được với API để tính hệ số
+            inverter.energy_anchor = {}
+    inverter.last_power_time = now
+    inverter.last_powers = powers
+
+def energy_readings(inverter):
+    if not inverter.energy_ready:
+        return []
+    return [("energy", counter, round(inverter.energy[counter], 3)) for counter, source, sign in ENERGY_COUNTERS]
+
+# Đối soát với tổng của API ngày: hiệu chỉnh hệ số theo độ tăng API / độ tăng tích phân thô,
+# và kéo tổng lên nếu đang thấp hơn API. Không bao giờ kéo xuống (HA total_increasing coi giảm là reset).
+def reconcile_energy(inverter, day, api_totals):
+    if roll_energy_day(inverter) != day:
+        return  # Qua nửa đêm trong lúc gọi API
+    low, high = ENERGY_GAIN_LIMITS
+    for counter, api_value in api_totals.items():
+        raw = inverter.energy_raw[counter]
+        anchor = inverter.energy_anchor.get(counter)
+        if anchor is None:
+            inverter.energy_anchor[counter] = [api_value, raw]
+        elif api_value - anchor[0] >= ENERGY_GAIN_MIN_DELTA and raw > anchor[1]:
+            ratio = (api_value - anchor[0]) / (raw - anchor[1])
+            gain = inverter.energy_gain.get(counter, 1.0)
+            inverter.energy_gain[counter] = min(max(gain + (ratio - gain) / 2, low), high)
+            inverter.energy_anchor[counter] = [api_value, raw]
+        if api_value > inverter.energy[counter] or not inverter.energy_ready:
+            inverter.energy[counter] = api_value
+    inverter.energy_ready = True
+
+def energy_state_snapshot():
+    # Chụp trên event loop: các dict energy đang được loop sửa, thread chỉ nhận bản sao
+    return copy.deepcopy({inverter.device_id: {field: getattr(inverter, field) for field in ENERGY_STATE_FIELDS}
+                          for inverter in inverters})
+
+def write_energy_state(state):
+    tmp_path = f"{ENERGY_STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, ENERGY_STATE_FILE)
+
+def save_energy_state():
+    if ENERGY_STATE_FILE:
+        write_energy_state(energy_state_snapshot())
+
+async def persist_energy_state():
+    await asyncio.to_thread(write_energy_state, energy_state_snapshot())
+
+def load_energy_state():
+    if not ENERGY_STATE_FILE or not os.path.exists(ENERGY_STATE_FILE):
+        return
+    try:
+        with open(ENERGY_STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Bỏ file energy hỏng {ENERGY_STATE_FILE}: {e}")
+        return
+    counters = {counter for counter, source, sign in ENERGY_COUNTERS}
+    for inverter in inverters:
+        saved = state.get(inverter.device_id)
+        if not saved or set(saved.get("energy", {})) != counters:
+            continue
+        for field in ENERGY_STATE_FIELDS:
+            setattr(inverter, field, saved[field])
+        print(f"[{inverter.device_id}] Khôi phục energy ngày {inverter.energy_date}: "
+              f"PV {inverter.energy['pvTotal']:.2f} kWh, Load {inverter.energy['loadTotal']:.2f} kWh")
+
+# GET JSON qua pool chung (giới hạn tốc độ chung cả fleet); kết nối hỏng do aiohttp tự bỏ
+async def api_get_json(url, timeout):
+    await api_limiter.acquire()
+    async with api_session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
 
-    if time.time() - last_session_refresh_time > SESSION_REFRESH_INTERVAL:
-        refresh_api_session()
-    
+# Hàm lấy dữ liệu energy totals từ API ngày, dùng để đối soát tổng tích phân cục bộ
+async def fetch_api_data(inverter):
     current_date = datetime.now().strftime("%Y-%m-%d")
-    api_url = f"{SERVER_HOST}/api/day/{DEVICE_ID}/{current_date}"
+    api_url = f"{SERVER_HOST}/api/day/{inverter.device_id}/{current_date}"
     print(f"Gửi yêu cầu tới: {api_url}")
 
     try:
-        response = api_session.get(api_url, headers={
-            "User-Agent": "Mozilla/5.0",
-            "Origin": "https://lumentree.net",
-            "Accept": "application/json"
-        }, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        data = await api_get_json(api_url, timeout=10)
 
         pv_total = (data.get("pv_raw", {}).get("pv", {}).get("tableValue", 0) / 10.0)
         bat_charge = (data.get("bat_raw", {}).get("bats", [{}])[0].get("tableValue", 0) / 10.0)
@@ -154,56 +520,59 @@ def fetch_api_data():
         grid_total = (data.get("other_raw", {}).get("grid", {}).get("tableValue", 0) / 10.0)
         essential_total = (data.get("other_raw", {}).get("essentialLoad", {}).get("tableValue", 0) / 10.0)
 
-        send_data_sensor("energy", "pvTotal", pv_total)
-        send_data_sensor("energy", "batCharge", bat_charge)
-        send_data_sensor("energy", "batDischarge", bat_discharge)
-        send_data_sensor("energy", "loadTotal", load_total)
-        send_data_sensor("energy", "gridTotal", grid_total)
-        send_data_sensor("energy", "essentialTotal", essential_total)
-
-        print("=== Dữ liệu tổng hợp từ API ===")
+        local_before = dict(inverter.energy)
+        reconcile_energy(inverter, current_date, {
+            "pvTotal": pv_total,
+            "batCharge": bat_charge,
+            "batDischarge": bat_discharge,
+            "loadTotal": load_total,
+            "gridTotal": grid_total,
+            "essentialTotal": essential_total,
+        })
+        sent, total = publish_sensors(inverter, energy_readings(inverter))
+
+        print(f"=== Dữ liệu tổng hợp từ API [{inverter.device_id}] ===")
         print(f"PV Total: {pv_total} kWh")
         print(f"Battery Charge: {bat_charge} kWh")
         print(f"Battery Discharge: {bat_discharge} kWh")
         print(f"Load Total: {load_total} kWh")
         print(f"Grid Total: {grid_total} kWh")
         print(f"Essential Load: {essential_total} kWh")
-
-        last_api_fetch_time = time.time()
-
-    except requests.Timeout:
-        print("Yêu cầu API bị timeout sau 10 giây")
-        refresh_api_session()
-    except requests.RequestException as e:
-        print(f"Lỗi khi gọi API: {e}")
-        refresh_api_session()
+        print("Local trước đối soát: " + ", ".join(f"{counter} {value:.2f}" for counter, value in local_before.items()))
+        print("Hệ số drift: " + ", ".join(f"{counter} {gain:.3f}" for counter, gain in inverter.energy_gain.items()))
+        print(f"Published {sent}/{total} energy sensors")
+
+    except asyncio.TimeoutError:
+        print(f"[{inverter.device_id}] Yêu cầu API bị timeout sau 10 giây")
+    except aiohttp.ClientError as e:
+        print(f"[{inverter.device_id}] Lỗi khi gọi API: {e}")
     except (json.JSONDecodeError, KeyError) as e:
-        print(f"Lỗi parse dữ liệu API: {e}")
+        print(f"[{inverter.device_id}] Lỗi parse dữ liệu API: {e}")
 
-# SỬA: Hàm mới - Fetch realtime data từ /api/realtime (thay thế WebSocket)
-def fetch_realtime_data():
-    global last_realtime_fetch_time, last_timestamp, api_session
-    if time.time() - last_realtime_fetch_time < REALTIME_POLL_INTERVAL:
-        return
+# Mẫu không lấy được từ cloud thì không có gì để đệm; chỉ ghi lại độ dài khoảng trống
+def note_api_failure(inverter):
+    if not inverter.api_failures:
+        inverter.api_down_since = time.time()
+    inverter.api_failures += 1
 
-    realtime_url = f"{SERVER_HOST}/api/realtime/{DEVICE_ID}"
+# SỬA: Hàm mới - Fetch realtime data từ /api/realtime (thay thế WebSocket)
+async def fetch_realtime_data(inverter):
+    realtime_url = f"{SERVER_HOST}/api/realtime/{inverter.device_id}"
     print(f"Gửi yêu cầu realtime tới: {realtime_url}")
 
     try:
-        response = api_session.get(realtime_url, headers={
-            "User-Agent": "Mozilla/5.0",
-            "Origin": "https://lumentree.net",
-            "Accept": "application/json"
-        }, timeout=5)  # Timeout ngắn hơn cho realtime
-        response.raise_for_status()
-        data = response.json()
+        data = await api_get_json(realtime_url, timeout=5)  # Timeout ngắn hơn cho realtime
 
         if not data or not data.get("data"):
-            print("Không có dữ liệu realtime")
+            print(f"[{inverter.device_id}] Không có dữ liệu realtime")
             return
 
         device_data = data["data"]
-        last_timestamp = device_data.get("timestamp", last_timestamp)  # Cập nhật timestamp nếu có
+        if inverter.api_failures:
+            print(f"[{inverter.device_id}] Realtime API hoạt động lại sau {inverter.api_failures} lần lỗi "
+                  f"({time.time() - inverter.api_down_since:.0f}s không có mẫu)")
+            inverter.api_failures = 0
+        inverter.last_timestamp = device_data.get("timestamp", inverter.last_timestamp)  # Cập nhật timestamp nếu có
 
         # Parse fields từ JS structure
         pv1V = float(device_data.get("pv1Voltage", 0) or 0)
@@ -232,7 +601,8 @@ def fetch_realtime_data():
         grid_current = grid / gridVoltage if gridVoltage else 0.0
         inverter_power = max(homeLoad - grid, 0)
         inverter_current = inverter_power / gridVoltage if gridVoltage else 0.0
-        grid_frequency = device_data.get("acInputFrequency", 50 + (random.randint(-5, 5) / 10.0))  # Giả sử nếu không có
+        # Không có tần số thì bỏ qua sensor (không bịa số ngẫu nhiên làm nhiễu recorder)
+        grid_frequency = float(device_data["acInputFrequency"]) if device_data.get("acInputFrequency") else None
 
         # Sensors realtime (gửi nếu value hợp lệ)
         sensors = [
@@ -256,53 +626,132 @@ def fetch_realtime_data():
             ("frequency", "Gird_Frequency", grid_frequency),
         ]
 
+        readings = []
         for measurement, name, value in sensors:
             if isinstance(value, (int, float)):
                 if measurement == "battery" and not (0 <= value <= 100):  # batteryPercent
                     continue
                 if value < 0 and measurement not in ["power", "current"]:
                     continue
-                send_data_sensor(measurement, name, value)
+                readings.append((measurement, name, value))
+        integrate_energy(inverter, readings)
+        sent, total = publish_sensors(inverter, readings + energy_readings(inverter))
 
-        print("=== Realtime Data ===")
+        print(f"=== Realtime Data [{inverter.device_id}] ===")
         print(f"PV Total Power: {totalPv} W | Load: {homeLoad} W | Grid: {grid} W | Battery SOC: {batterySoc} %")
         print(f"PV Current: {pv_current:.1f} A | Grid Current: {grid_current:.1f} A | Inverter Power: {inverter_power} W")
-        print(f"Timestamp: {last_timestamp}")
-
-        last_realtime_fetch_time = time.time()
-
-    except requests.Timeout:
-        print("Yêu cầu realtime timeout sau 5 giây")
-    except requests.RequestException as e:
-        print(f"Lỗi khi gọi realtime API: {e}")
+        print(f"Timestamp: {inverter.last_timestamp} | Published {sent}/{total} sensors")
+
+    except asyncio.TimeoutError:
+        note_api_failure(inverter)
+        print(f"[{inverter.device_id}] Yêu cầu realtime timeout sau 5 giây")
+    except aiohttp.ClientError as e:
+        note_api_failure(inverter)
+        print(f"[{inverter.device_id}] Lỗi khi gọi realtime API: {e}")
     except (json.JSONDecodeError, KeyError) as e:
-        print(f"Lỗi parse realtime data: {e}")
-
-# SỬA: Loop cho realtime polling (thay thế run_websocket)
-def realtime_poll_loop():
-    while True:
-        fetch_realtime_data()
-        time.sleep(REALTIME_POLL_INTERVAL)  # Poll mỗi 2 giây
-
-# Hàm chạy API fetch định kỳ (giữ nguyên)
-def api_fetch_loop():
-    while True:
-        fetch_api_data()
-        time.sleep(10)
+        print(f"[{inverter.device_id}] Lỗi parse realtime data: {e}")
+
+class PeriodicJob:
+    """Coroutine chạy theo lưới thời gian cố định start + offset + k*interval, cộng jitter riêng từng lần."""
+    def __init__(self, name, func, interval, jitter=0, offset=0, args=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.offset = offset  # Lệch pha để các inverter không gọi API cùng một lúc
+        self.next_tick = 0
+        self.task = None
+        self.skipped = 0
+
+    async def run(self):
+        try:
+            await self.func(*self.args)
+        except Exception as e:
+            print(f"Lỗi không mong đợi trong job {self.name}: {e}")
+
+# Một scheduler cho mọi job định kỳ: ngủ đúng tới hạn gần nhất, không wakeup thừa.
+# Response chậm không làm trôi nhịp; tick trùng lúc job cũ còn chạy thì bỏ qua.
+async def run_scheduler(jobs):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    queue = []
+    for index, job in enumerate(jobs):
+        job.next_tick = start + job.offset
+        heapq.heappush(queue, (job.next_tick + random.uniform(0, job.jitter), index, job))
 
-# Main (SỬA: Thay WebSocket thread bằng realtime_poll_loop)
-if __name__ == "__main__":
-    mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    try:
+        while True:
+            due, index, job = heapq.heappop(queue)
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if job.task is None or job.task.done():
+                job.task = asyncio.create_task(job.run())
+            else:
+                job.skipped += 1
+                print(f"Job {job.name} chưa xong sau {job.interval}s, bỏ qua 1 lượt (đã bỏ {job.skipped})")
+
+            job.next_tick += job.interval
+            now = loop.time()
+            if job.next_tick < now:
+                # Bị trễ quá một chu kỳ (máy treo, GC...): nhảy tới tick kế tiếp, không chạy bù dồn dập
+                job.next_tick += ((now - job.next_tick) // job.interval + 1) * job.interval
+            heapq.heappush(queue, (job.next_tick + random.uniform(0, job.jitter), index, job))
+    finally:
+        # Dừng job đang chạy trước khi session HTTP bị đóng
+        running = [job.task for job in jobs if job.task and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+async def main():
+    global api_session, api_limiter
+    load_energy_state()
+    if BUFFER_DIR:
+        os.makedirs(BUFFER_DIR, exist_ok=True)
+        for inverter in inverters:
+            if os.path.exists(backlog_path(inverter)):
+                try:
+                    inverter.backlog.load(backlog_path(inverter))
+                    print(f"[{inverter.device_id}] Nạp {len(inverter.backlog)} dòng backlog từ đĩa")
+                except (OSError, ValueError, EOFError) as e:
+                    print(f"[{inverter.device_id}] Bỏ file backlog hỏng: {e}")
+    # MQTT (paho) giữ network thread riêng, tự reconnect; publish() thread-safe
+    mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
     mqtt_client.loop_start()
 
-    # Khởi động realtime polling trong thread riêng
-    threading.Thread(target=realtime_poll_loop, daemon=True).start()
-    # Khởi động API fetch loop trong thread riêng
-    threading.Thread(target=api_fetch_loop, daemon=True).start()
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE, ttl_dns_cache=300)
+    try:
+        async with aiohttp.ClientSession(connector=connector, headers=API_HEADERS) as session:
+            api_session = session
+            api_limiter = RateLimiter(API_RATE_LIMIT)
+            jobs = []
+            # Trải đều pha của các inverter trên mỗi chu kỳ
+            for index, inverter in enumerate(inverters):
+                phase = index / len(inverters)
+                jobs.append(PeriodicJob(f"realtime {inverter.device_id}", fetch_realtime_data, REALTIME_POLL_INTERVAL,
+                                        REALTIME_JITTER, phase * REALTIME_POLL_INTERVAL, (inverter,)))
+                # Lần đối soát đầu trải trong tối đa 60 giây để energy sớm có mốc
+                jobs.append(PeriodicJob(f"day {inverter.device_id}", fetch_api_data, API_FETCH_INTERVAL,
+                                        API_FETCH_JITTER, phase * min(API_FETCH_INTERVAL, 60), (inverter,)))
+            if ENERGY_STATE_FILE:
+                jobs.append(PeriodicJob("energy state", persist_energy_state, ENERGY_SAVE_INTERVAL,
+                                        offset=ENERGY_SAVE_INTERVAL))
+            print(f"Theo dõi {len(inverters)} inverter: {', '.join(i.device_id for i in inverters)}")
+            await run_scheduler(jobs)
+    finally:
+        save_energy_state()
+        if BUFFER_DIR:
+            for inverter in inverters:
+                flush_bucket(inverter)
+                inverter.backlog.save(backlog_path(inverter))
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
 
+if __name__ == "__main__":
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(main())
     except KeyboardInterrupt:
-        mqtt_client.loop_stop()
         print("Đã dừng chương trình")
\ No newline at end of file